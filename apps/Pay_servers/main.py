@@ -1,10 +1,14 @@
-import requests
+import httpx
 import datetime
 import logging
 from telegram import Bot
+from telegram.error import NetworkError, RetryAfter
 from apscheduler.schedulers.asyncio import AsyncIOScheduler
 import asyncio
+import json
 import os
+import time
+from email.utils import parsedate_to_datetime
 
 # ---------------------------
 # CONFIG
@@ -14,6 +18,16 @@ CHAT_ID = os.environ.get("CHAT_ID_RUVDS")
 RUVDS_TOKEN = os.environ.get("RUVDS_TOKEN")
 
 API_URL = "https://api.ruvds.com/v2"
+API_TIMEOUT = httpx.Timeout(20.0, connect=5.0)
+API_RETRIES = 3          # повторы на сетевые ошибки, 429 и 5xx
+API_CONCURRENCY = 8      # одновременных запросов к RuVDS
+
+STATE_PATH = os.environ.get("STATE_PATH", "/app/data/payservers_state.json")
+DETAILS_TTL_SEC = 7 * 24 * 3600   # стоимость и IP далёких от оплаты серверов обновляем раз в неделю
+ALERT_DAYS = 5                    # за сколько дней предупреждать
+
+TG_RETRIES = 5
+TG_MAX_TEXT = 4096
 
 bot = Bot(token=TELEGRAM_TOKEN)
 
@@ -23,40 +37,191 @@ logging.basicConfig(level=logging.INFO)
 # ---------------------------
 # API CALLS
 # ---------------------------
-def api_get(path: str):
-    headers = {"Authorization": f"Bearer {RUVDS_TOKEN}"}
-    r = requests.get(API_URL + path, headers=headers)
-    r.raise_for_status()
-    return r.json()
+_client = None
+_api_sem = None
+
+
+def api_client():
+    """Один AsyncClient на процесс: пул соединений с keep-alive и таймауты."""
+    global _client
+    if _client is None:
+        _client = httpx.AsyncClient(
+            base_url=API_URL,
+            headers={"Authorization": f"Bearer {RUVDS_TOKEN}"},
+            timeout=API_TIMEOUT,
+            limits=httpx.Limits(max_connections=API_CONCURRENCY,
+                                max_keepalive_connections=API_CONCURRENCY),
+        )
+    return _client
+
+
+def api_semaphore():
+    """Не больше API_CONCURRENCY запросов в полёте — столько же соединений в пуле клиента."""
+    global _api_sem
+    if _api_sem is None:
+        _api_sem = asyncio.Semaphore(API_CONCURRENCY)
+    return _api_sem
+
+
+def retry_after_delay(value, default):
+    """Retry-After бывает числом секунд или HTTP-датой; непонятное — обычный бэкофф."""
+    if not value:
+        return default
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        when = parsedate_to_datetime(value)
+        return max(0.0, (when - datetime.datetime.now(datetime.timezone.utc)).total_seconds())
+    except (TypeError, ValueError):
+        return default
+
 
+async def api_get(path: str):
+    for attempt in range(1, API_RETRIES + 1):
+        try:
+            async with api_semaphore():
+                r = await api_client().get(path)
+            if r.status_code in (429, 500, 502, 503, 504) and attempt < API_RETRIES:
+                delay = retry_after_delay(r.headers.get("Retry-After"), 2 ** attempt)
+                logging.warning("RuVDS %s -> %s, повтор через %.0f сек", path, r.status_code, delay)
+                await asyncio.sleep(delay)
+                continue
+            r.raise_for_status()
+            return r.json()
+        except httpx.TransportError as e:
+            if attempt == API_RETRIES:
+                raise
+            logging.warning("RuVDS %s: %s, повтор %d/%d", path, e, attempt, API_RETRIES)
+            await asyncio.sleep(2 ** attempt)
 
-def get_servers():
-    return api_get("/servers?get_paid_till=true")["servers"]
 
+async def get_servers():
+    return (await api_get("/servers?get_paid_till=true"))["servers"]
 
-def get_cost(server_id: int):
-    return api_get(f"/servers/{server_id}/cost")["cost_rub"]
 
-def get_ip(server_id: int):
-    data = api_get(f"/servers/{server_id}/networks")
+async def get_cost(server_id: int):
+    return (await api_get(f"/servers/{server_id}/cost"))["cost_rub"]
+
+async def get_ip(server_id: int):
+    data = await api_get(f"/servers/{server_id}/networks")
     v4 = data.get("v4", [])
     if not v4:
         return "нет IP"
     return v4[0]["ip_address"]
 
 
+async def get_details(server_id: int):
+    """Стоимость и IP сервера параллельно; ошибка одного сервера не валит всю проверку."""
+    cost, ip = await asyncio.gather(get_cost(server_id), get_ip(server_id),
+                                    return_exceptions=True)
+    if isinstance(cost, Exception):
+        logging.error("Не удалось получить стоимость сервера %s: %s", server_id, cost)
+        cost = None
+    if isinstance(ip, Exception):
+        logging.error("Не удалось получить IP сервера %s: %s", server_id, ip)
+        ip = None
+    return cost, ip
+
+
+# ---------------------------
+# STATE
+# ---------------------------
+def load_state():
+    """{server_id: {paid_till, cost, ip, fetched_at, alert_state, last_alert}}"""
+    try:
+        with open(STATE_PATH, "r") as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+    except Exception as e:
+        logging.error("Не удалось прочитать %s: %s", STATE_PATH, e)
+        return {}
+
+
+def save_state(state):
+    os.makedirs(os.path.dirname(STATE_PATH) or ".", exist_ok=True)
+    tmp = STATE_PATH + ".tmp"
+    with open(tmp, "w") as f:
+        json.dump(state, f, ensure_ascii=False, indent=1)
+    os.replace(tmp, STATE_PATH)
+
+
+def alert_state(days_left: int):
+    if days_left < 0:
+        return "overdue"
+    if 0 < days_left <= ALERT_DAYS:
+        return "expiring"
+    return "ok"
+
+
+def needs_details(entry: dict, paid_till: str, days_left: int):
+    """Стоимость и IP берём из кэша, кроме серверов у окна оплаты и со сменившимся paid_till."""
+    return (
+        entry.get("paid_till") != paid_till
+        or days_left <= ALERT_DAYS
+        or entry.get("cost") is None
+        or entry.get("ip") is None
+        or time.time() - entry.get("fetched_at", 0) > DETAILS_TTL_SEC
+    )
+
+
+# ---------------------------
+# TELEGRAM
+# ---------------------------
+def digest_chunks(messages):
+    """
+    Все уведомления проверки одним сообщением (или несколькими, если не влезает).
+    Возвращает [(текст, номера сообщений в нём)].
+    """
+    chunks, cur, idx = [], "", []
+    for i, msg in enumerate(messages):
+        if cur and len(cur) + 2 + len(msg) > TG_MAX_TEXT:
+            chunks.append((cur, idx))
+            cur, idx = "", []
+        cur = f"{cur}\n\n{msg}" if cur else msg
+        idx.append(i)
+    if cur:
+        chunks.append((cur, idx))
+    return chunks
+
+
+async def send_digest(messages):
+    """Шлёт дайджест; возвращает номера сообщений, которые точно доставлены."""
+    delivered = set()
+    for chunk, idx in digest_chunks(messages):
+        for attempt in range(1, TG_RETRIES + 1):
+            try:
+                await bot.send_message(chat_id=CHAT_ID, text=chunk)
+                delivered.update(idx)
+                break
+            except RetryAfter as e:
+                # Telegram сам говорит, сколько ждать
+                logging.warning("Telegram просит подождать %s сек", e.retry_after)
+                await asyncio.sleep(e.retry_after)
+            except NetworkError as e:
+                logging.warning("Telegram: %s, попытка %d/%d", e, attempt, TG_RETRIES)
+                await asyncio.sleep(2 ** attempt)
+            except Exception as e:
+                logging.error("Не удалось отправить уведомления: %s", e)
+                break
+    return delivered
+
+
 # ---------------------------
 # MAIN LOGIC
 # ---------------------------
 async def check_servers():
     
-    servers = get_servers()
+    servers = await get_servers()
     today = datetime.datetime.utcnow().date()
 
     print("DEBUG SERVERS:", servers)
 
+    state = load_state()
+    paid = []
     for s in servers:
-        server_id = s["virtual_server_id"]
         paid_till_raw = s.get("paid_till")
 
         if not paid_till_raw:
@@ -65,33 +230,77 @@ async def check_servers():
         paid_till = datetime.datetime.fromisoformat(
             paid_till_raw.replace("Z", "+00:00")
         ).date()
+        paid.append((s["virtual_server_id"], paid_till))
+
+    # Сервера, которых больше нет в аккаунте, забываем (ключи в JSON — строки)
+    state = {k: v for k, v in state.items() if k in {str(server_id) for server_id, _ in paid}}
+
+    stale = [
+        server_id for server_id, paid_till in paid
+        if needs_details(state.get(str(server_id), {}), paid_till.isoformat(), (paid_till - today).days)
+    ]
+    logging.info("Серверов %d, запрашиваю детали для %d", len(paid), len(stale))
+
+    # Только нужные сервера и разом, не больше API_CONCURRENCY запросов одновременно
+    details = await asyncio.gather(*(get_details(server_id) for server_id in stale))
+    for server_id, (cost, ip) in zip(stale, details):
+        entry = state.setdefault(str(server_id), {})
+        if cost is not None:
+            entry["cost"] = cost
+        if ip is not None:
+            entry["ip"] = ip
+        if cost is not None and ip is not None:
+            entry["fetched_at"] = time.time()
 
-        cost = get_cost(server_id)
+    alerts = []
+    for server_id, paid_till in paid:
+        entry = state.setdefault(str(server_id), {})
         days_left = (paid_till - today).days
-        ip = get_ip(server_id)
+        cost = entry.get("cost", "?")
+        ip = entry.get("ip", f"#{server_id}")
 
         print("DEBUG PAY DATE:", paid_till, type(paid_till))
         print("DAYS LEFT:", days_left)
         print("DEBUG IP:", ip)
 
-        # 1) За день до конца оплаты
-        if (0 < days_left <= 5):
+        # Смена paid_till (продлили/частично оплатили) — это тоже новое состояние
+        new_state = alert_state(days_left)
+        changed = (new_state != entry.get("alert_state")
+                   or paid_till.isoformat() != entry.get("paid_till"))
+        entry["paid_till"] = paid_till.isoformat()
+        entry["alert_state"] = new_state
+
+        msg = None
+        # 1) Оплата заканчивается — один раз при входе в окно ALERT_DAYS
+        if new_state == "expiring" and changed:
             msg = (
                 f"⚠️ Через {days_left} дней, ({paid_till.strftime('%d.%m.%Y')}) "
                 f"у сервера с IP {ip} заканчивается оплата.\n"
                 f"Необходимо пополнить баланс на {cost} ₽."
             )
-            await bot.send_message(chat_id=CHAT_ID, text=msg)
 
         # 2) Просроченный сервер → пишем каждый день
-        if days_left < 0:
+        if new_state == "overdue" and entry.get("last_alert") != today.isoformat():
             overdue_days = abs(days_left)
             msg = (
                 f"❗ Оплата сервера #{ip} истекла {paid_till.strftime('%d.%m.%Y')}.\n"
                 f"Сервер не оплачен уже {overdue_days} дн.\n"
                 f"Стоимость продления: {cost} ₽."
             )
-            await bot.send_message(chat_id=CHAT_ID, text=msg)
+
+        if msg:
+            alerts.append((entry, msg))
+
+    if alerts:
+        delivered = await send_digest([msg for _, msg in alerts])
+        for i, (entry, _) in enumerate(alerts):
+            if i in delivered:
+                entry["last_alert"] = today.isoformat()
+            else:
+                # не отправили — повторим при следующей проверке (доставленные части не дублируем)
+                entry["alert_state"] = None
+
+    save_state(state)
 
 
 # ---------------------------
@@ -1,11 +1,18 @@
 import os
 import json
 import time
+import base64
+import queue
+import shutil
+import threading
 from datetime import datetime, timedelta, timezone
 from pathlib import Path
 
 import requests
-from PIL import Image
+from PIL import Image, ImageChops
+from apscheduler.executors.pool import ThreadPoolExecutor
+from apscheduler.schedulers.blocking import BlockingScheduler
+from apscheduler.triggers.cron import CronTrigger
 from selenium import webdriver
 from selenium.webdriver.chrome.options import Options
 
@@ -14,10 +21,45 @@ TG_BOT_TOKEN = os.environ.get("TG_BOT_TOKEN")
 CHAT_ID = os.environ.get("TG_CHAT_ID")
 DATALENS_URL = "https://datalens.ru/35o65aulrl0wo-kc-obshiy"
 
-SCREENSHOT_PATH = Path("/app/data/datalens_dashboard.png")
+SCREENSHOT_DIR = Path("/app/data/datalens")
 COOKIES_PATH = Path("/app/data/yandex_cookies.json")
 SELENIUM_HOST = os.environ.get("SELENIUM_HOST", "http://selenium-chrome:4444/wd/hub")
 
+# Ожидание отрисовки дашборда вместо фиксированных 20 сек
+READY_TIMEOUT_SEC = float(os.environ.get("READY_TIMEOUT_SEC", "60"))   # верхняя граница ожидания
+READY_IDLE_MS = int(os.environ.get("READY_IDLE_MS", "1500"))           # сколько сеть должна молчать
+SPINNER_SELECTOR = os.environ.get(
+    "DATALENS_SPINNER_SELECTOR",
+    ".yc-spin, .g-spin, .g-loader, .dl-loader, [class*='loader_'], [class*='_loading']")
+WIDGET_SELECTOR = os.environ.get("DATALENS_WIDGET_SELECTOR", ".dashkit-grid-item, .react-grid-item")
+
+# Области дашборда для отчёта: [{"name": ..., "selector": CSS} | {"name": ..., "clip": [x, y, w, h]}
+#                               | {"name": ..., "clip_rel": [x, y, w, h] — доли окна, 0..1}]
+# По умолчанию — та же полоса 25%–55% высоты окна, что резалась раньше (от фактического размера окна Grid)
+DEFAULT_REGIONS = [{"name": "dashboard", "clip_rel": [0, 0.25, 1, 0.30]}]
+REGIONS = json.loads(os.environ.get("DATALENS_REGIONS", "") or "null") or DEFAULT_REGIONS
+
+# Долгоживущая сессия на selenium-chrome
+KEEPALIVE_SEC = int(os.environ.get("SESSION_KEEPALIVE_SEC", "120"))          # Grid закрывает простаивающую сессию через 300 сек
+SESSION_MAX_AGE_SEC = int(os.environ.get("SESSION_MAX_AGE_SEC", str(24 * 3600)))  # раз в сутки пересоздаём браузер
+
+# Дашборды: [{"name", "url", "cron", "regions", "chat_id", "title"}]; без файла — один DATALENS_URL
+DASHBOARDS_PATH = Path(os.environ.get("DASHBOARDS_PATH", "/app/data/datalens_dashboards.json"))
+DEFAULT_CRON = "10 9-23 * * *"                                   # как раньше: в :10 каждого часа с 9 до 23
+MAX_SESSIONS = int(os.environ.get("SE_NODE_MAX_SESSIONS", "3"))  # столько браузеров даёт selenium-chrome
+TIMEZONE = "Europe/Moscow"
+
+# Отправляем только изменившиеся области
+CHANGE_MIN_PIXELS = int(os.environ.get("CHANGE_MIN_PIXELS", "40"))     # столько пикселей должно поменяться (одна цифра — около сотни)
+PIXEL_TOLERANCE = int(os.environ.get("PIXEL_TOLERANCE", "24"))          # шум сглаживания/рендера, 0..255
+UNCHANGED_MODE = os.environ.get("UNCHANGED_MODE", "note")               # note — короткий текст, silent — ничего
+STALLED_AFTER_RUNS = int(os.environ.get("STALLED_AFTER_RUNS", "3"))   # столько отчетов подряд без изменений — дашборд «встал»
+
+# Telegram
+TG_COALESCE_SEC = float(os.environ.get("TG_COALESCE_SEC", "3"))   # тексты за это окно — одним сообщением на чат
+TG_MAX_RETRIES = 5
+TG_MAX_TEXT = 4096
+
 
 def log(msg):
     print(f"[{datetime.now().strftime('%Y-%m-%d %H:%M:%S')}] {msg}", flush=True)
@@ -27,61 +69,204 @@ def now_moscow():
     return datetime.now(timezone.utc) + timedelta(hours=3)
 
 
-def save_cookies(driver):
-    cookies = driver.get_cookies()
-    COOKIES_PATH.parent.mkdir(parents=True, exist_ok=True)
-    with open(COOKIES_PATH, 'w') as f:
-        json.dump(cookies, f)
-    return len(cookies)
+def cdp(driver, cmd, params=None):
+    """CDP-команда через Grid: у webdriver.Remote нет execute_cdp_cmd."""
+    driver.command_executor._commands["executeCdpCommand"] = (
+        "POST", "/session/$sessionId/goog/cdp/execute")
+    return driver.execute("executeCdpCommand", {"cmd": cmd, "params": params or {}})["value"]
 
 
-def load_cookies(driver):
-    if not COOKIES_PATH.exists():
-        return False
-    try:
-        with open(COOKIES_PATH, 'r') as f:
-            cookies = json.load(f)
-
-        # Группируем cookies по доменам
-        domains = {}
-        for cookie in cookies:
-            domain = cookie.get('domain', '')
-            if domain not in domains:
-                domains[domain] = []
-            domains[domain].append(cookie)
-
-        # Загружаем cookies для каждого домена
-        loaded = 0
-        for domain, domain_cookies in domains.items():
-            # Определяем URL для домена
-            clean_domain = domain.lstrip('.')
-            if 'yandex' in clean_domain:
-                url = f"https://{clean_domain}"
-            elif 'datalens' in clean_domain:
-                url = f"https://{clean_domain}"
-            else:
-                continue
+class CookieStore:
+    """Cookies по доменам: атомарная запись только при изменениях, без протухших."""
 
+    def __init__(self, path):
+        self.path = path
+        self.by_domain = {}     # domain -> {(name, path): cookie}
+        self.dirty = False
+        self.lock = threading.RLock()   # один store на все сессии
+        if path.exists():
             try:
-                driver.get(url)
-                time.sleep(1)
-                for cookie in domain_cookies:
-                    cookie.pop('sameSite', None)
-                    cookie.pop('expiry', None)
-                    try:
-                        driver.add_cookie(cookie)
-                        loaded += 1
-                    except:
-                        pass
-            except:
-                pass
+                with open(path, 'r') as f:
+                    self.update(json.load(f))
+            except Exception as e:
+                log(f"Ошибка чтения cookies: {e}")
+            self.dirty = self.prune()
+
+    def __len__(self):
+        return sum(len(v) for v in self.by_domain.values())
+
+    def cookies(self):
+        with self.lock:
+            return [c for bucket in self.by_domain.values() for c in bucket.values()]
+
+    def update(self, cookies):
+        with self.lock:
+            return self._update(cookies)
+
+    def _update(self, cookies):
+        changed = False
+        for c in cookies:
+            if not c.get('name'):
+                continue
+            bucket = self.by_domain.setdefault(c.get('domain', ''), {})
+            key = (c['name'], c.get('path', '/'))
+            if bucket.get(key) != c:
+                bucket[key] = c
+                changed = True
+        changed = self.prune() or changed
+        self.dirty = self.dirty or changed
+        return changed
+
+    def prune(self):
+        now = time.time()
+        removed = False
+        for domain in list(self.by_domain):
+            bucket = self.by_domain[domain]
+            for key in [k for k, c in bucket.items() if c.get('expiry') and c['expiry'] < now]:
+                del bucket[key]
+                removed = True
+            if not bucket:
+                del self.by_domain[domain]
+        return removed
+
+    def save(self):
+        with self.lock:
+            return self._save()
+
+    def _save(self):
+        if not self.dirty:
+            return False
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        tmp = self.path.with_suffix(self.path.suffix + ".tmp")
+        with open(tmp, 'w') as f:
+            json.dump(self.cookies(), f)
+        os.replace(tmp, self.path)
+        self.dirty = False
+        return True
 
+    def inject(self, driver):
+        """Все cookies одним вызовом Network.setCookies — без захода на каждый домен."""
+        params = []
+        for c in self.cookies():
+            p = {
+                "name": c['name'],
+                "value": c.get('value', ''),
+                "domain": c.get('domain', ''),
+                "path": c.get('path', '/'),
+                "secure": bool(c.get('secure', False)),
+                "httpOnly": bool(c.get('httpOnly', False)),
+            }
+            if c.get('sameSite') in ("Strict", "Lax", "None"):
+                p["sameSite"] = c['sameSite']
+            if c.get('expiry'):
+                p["expires"] = c['expiry']
+            params.append(p)
+        if params:
+            cdp(driver, "Network.setCookies", {"cookies": params})
+        return len(params)
+
+
+def save_cookies(driver, store=None):
+    store = store or CookieStore(COOKIES_PATH)
+    store.update(driver.get_cookies())
+    store.save()
+    return len(store)
+
+
+def load_cookies(driver, store=None):
+    store = store or CookieStore(COOKIES_PATH)
+    if not len(store):
+        return False
+    try:
+        loaded = store.inject(driver)
         log(f"Загружено {loaded} cookies")
         return True
     except Exception as e:
         log(f"Ошибка загрузки cookies: {e}")
         return False
 
+# Ставится до загрузки страницы: считает незавершённые fetch/XHR
+INFLIGHT_TRACKER_JS = """
+(() => {
+  if (window.__dlInflight !== undefined) return;
+  window.__dlInflight = 0;
+  window.__dlLastNet = Date.now();
+  const done = () => { window.__dlInflight--; window.__dlLastNet = Date.now(); };
+  const origFetch = window.fetch;
+  if (origFetch) {
+    window.fetch = function() {
+      window.__dlInflight++; window.__dlLastNet = Date.now();
+      return origFetch.apply(this, arguments).finally(done);
+    };
+  }
+  const origSend = XMLHttpRequest.prototype.send;
+  XMLHttpRequest.prototype.send = function() {
+    window.__dlInflight++; window.__dlLastNet = Date.now();
+    this.addEventListener('loadend', done, {once: true});
+    return origSend.apply(this, arguments);
+  };
+})();
+"""
+
+READY_PROBE_JS = """
+const spinnerSel = arguments[0], widgetSel = arguments[1];
+const visible = el => {
+  const r = el.getBoundingClientRect();
+  return r.width > 0 && r.height > 0 && getComputedStyle(el).visibility !== 'hidden';
+};
+const widgets = Array.from(document.querySelectorAll(widgetSel));
+// Пустым считаем только виджет-график, который ещё не отрисовал canvas/svg/таблицу;
+// заголовки, тексты и прочие виджеты на готовность не влияют
+const empty = widgets.filter(w =>
+  w.querySelector('[class*="chartkit"]') && !w.querySelector('canvas, svg, table, img')).length;
+const tracked = window.__dlInflight !== undefined;
+return {
+  state: document.readyState,
+  spinners: Array.from(document.querySelectorAll(spinnerSel)).filter(visible).length,
+  widgets: widgets.length,
+  empty: empty,
+  inflight: tracked ? window.__dlInflight : -1,
+  sinceNet: tracked ? Date.now() - window.__dlLastNet : -1,
+  resources: performance.getEntriesByType('resource').length,
+};
+"""
+
+
+def wait_dashboard_ready(driver, timeout=None, idle_ms=None):
+    """
+    Ждёт, пока дашборд дорисуется: документ загружен, сеть молчит idle_ms,
+    спиннеров нет, графики отрисованы. Возвращает True/False (таймаут).
+    """
+    timeout = READY_TIMEOUT_SEC if timeout is None else timeout
+    idle_ms = READY_IDLE_MS if idle_ms is None else idle_ms
+    start = time.time()
+    last_resources, stable_since = -1, time.time()
+    probe = {}
+    while time.time() - start < timeout:
+        try:
+            probe = driver.execute_script(READY_PROBE_JS, SPINNER_SELECTOR, WIDGET_SELECTOR)
+        except Exception as e:
+            log(f"Ошибка проверки готовности: {e}")
+            time.sleep(0.5)
+            continue
+
+        # Если трекер не встал — сеть считаем по Resource Timing
+        if probe["resources"] != last_resources:
+            last_resources, stable_since = probe["resources"], time.time()
+        if probe["inflight"] >= 0:
+            net_idle = probe["inflight"] <= 0 and probe["sinceNet"] >= idle_ms
+        else:
+            net_idle = (time.time() - stable_since) * 1000 >= idle_ms
+
+        if probe["state"] == "complete" and net_idle and not probe["spinners"] and not probe["empty"]:
+            log(f"Дашборд готов за {time.time() - start:.1f} сек ({probe['widgets']} виджетов)")
+            return True
+        time.sleep(0.3)
+
+    log(f"Дашборд не дорисовался за {timeout:.0f} сек: {probe}")
+    return False
+
+
 def create_driver():
     options = Options()
     options.add_argument("--no-sandbox")
@@ -102,93 +287,486 @@ def first_run_mode():
     if not driver:
         return
 
-    all_cookies = {}
+    store = CookieStore(COOKIES_PATH)
 
     try:
         driver.get(DATALENS_URL)
         log("Страница открыта. Залогинься в Яндексе через VNC!")
-        log("Cookies сохраняются каждые 3 секунды.")
+        log("Cookies проверяются каждые 3 секунды, файл пишется только при изменениях.")
         log("Когда закончишь — нажми Ctrl+C")
 
         while True:
             time.sleep(3)
-            cookies = driver.get_cookies()
-
-            for cookie in cookies:
-                key = f"{cookie.get('domain', '')}_{cookie.get('name', '')}"
-                all_cookies[key] = cookie
-
-            # Сохраняем КАЖДЫЙ раз
-            COOKIES_PATH.parent.mkdir(parents=True, exist_ok=True)
-            with open(COOKIES_PATH, 'w') as f:
-                json.dump(list(all_cookies.values()), f)
-
-            log(f"Сохранено {len(all_cookies)} cookies")
+            # get_cookies видит только текущий домен — копим всё в store
+            store.update(driver.get_cookies())
+            if store.save():
+                log(f"Сохранено {len(store)} cookies")
 
     except KeyboardInterrupt:
         log("Остановлено")
     finally:
         driver.quit()
-        log(f"Готово. Итого {len(all_cookies)} cookies. Убери FIRST_RUN=true.")
+        log(f"Готово. Итого {len(store)} cookies. Убери FIRST_RUN=true.")
+
+class DriverSession:
+    """
+    Одна авторизованная сессия на selenium-chrome между отчётами.
+    Перед выдачей проверяется живость, при сбое сессия пересоздаётся
+    (cookies + трекер сети), между отчётами — keepalive, чтобы Grid её не закрыл.
+    """
+
+    def __init__(self, store=None):
+        self.driver = None
+        self.created_at = 0
+        self.store = store or CookieStore(COOKIES_PATH)
+
+    def healthy(self):
+        if not self.driver:
+            return False
+        try:
+            self.driver.execute_script("return 1")
+            return True
+        except Exception as e:
+            log(f"Сессия браузера недоступна: {e}")
+            return False
 
-def make_screenshot():
-    driver = create_driver()
+    def get(self):
+        if self.driver and time.time() - self.created_at > SESSION_MAX_AGE_SEC:
+            log("Сессия слишком старая, пересоздаю")
+            self.reset()
+        if self.healthy():
+            return self.driver
+        self.reset()
+
+        driver = create_driver()
+        if not driver:
+            return None
+        load_cookies(driver, self.store)
+        try:
+            cdp(driver, "Page.addScriptToEvaluateOnNewDocument", {"source": INFLIGHT_TRACKER_JS})
+        except Exception as e:
+            log(f"Трекер сети не установлен: {e}")
+
+        self.driver, self.created_at = driver, time.time()
+        log("Новая сессия браузера")
+        return driver
+
+    def keepalive(self):
+        # Без команд Grid считает сессию брошенной; мёртвую пересоздадим при следующем get()
+        if self.driver and not self.healthy():
+            self.reset()
+
+    def save_cookies(self):
+        """Живая сессия продлевает cookies — сохраняем их, файл пишется только при изменениях."""
+        try:
+            save_cookies(self.driver, self.store)
+        except Exception as e:
+            log(f"Ошибка сохранения cookies: {e}")
+
+    def reset(self):
+        if self.driver:
+            try:
+                self.driver.quit()
+            except Exception:
+                pass
+        self.driver = None
+
+
+class SessionPool:
+    """MAX_SESSIONS сессий на весь бот: отчёты берут свободную, Grid не переполняется."""
+
+    def __init__(self, size):
+        store = CookieStore(COOKIES_PATH)
+        self.sessions = [DriverSession(store) for _ in range(size)]
+        # LIFO: следующий отчёт берёт только что отработавшую (тёплую) сессию,
+        # остальные браузеры поднимаются, лишь когда отчёты реально идут параллельно
+        self.free = queue.LifoQueue()
+        for session in self.sessions:
+            self.free.put(session)
+
+    def acquire(self):
+        return self.free.get()
+
+    def release(self, session):
+        self.free.put(session)
+
+    def keepalive(self):
+        # Пингуем только свободные сессии — занятые и так работают
+        idle = []
+        try:
+            while True:
+                idle.append(self.free.get_nowait())
+        except queue.Empty:
+            pass
+        for session in idle:
+            session.keepalive()
+        for session in reversed(idle):  # порядок стека сохраняем
+            self.free.put(session)
+
+    def close(self):
+        for session in self.sessions:
+            session.reset()
+
+
+REGION_RECT_JS = """
+const el = document.querySelector(arguments[0]);
+if (!el) return null;
+el.scrollIntoView({block: 'center'});
+const r = el.getBoundingClientRect();
+if (!r.width || !r.height) return null;
+return {x: r.left + window.scrollX, y: r.top + window.scrollY, width: r.width, height: r.height};
+"""
+
+
+def capture_region(driver, region, out_dir):
+    """Снимает область прямо в браузере (CDP, clip) — без полного кадра и кропа."""
+    name = region["name"]
+    if region.get("selector"):
+        rect = driver.execute_script(REGION_RECT_JS, region["selector"])
+        if not rect:
+            log(f"Область {name}: элемент {region['selector']} не найден")
+            return None
+    elif region.get("clip_rel"):
+        # Доли видимого окна, как раньше резался скриншот экрана
+        vw, vh, sx, sy = driver.execute_script(
+            "return [window.innerWidth, window.innerHeight, window.scrollX, window.scrollY];")
+        x, y, w, h = region["clip_rel"]
+        rect = {"x": sx + int(vw * x), "y": sy + int(vh * y), "width": int(vw * w), "height": int(vh * h)}
+    else:
+        x, y, w, h = region["clip"]
+        rect = {"x": x, "y": y, "width": w, "height": h}
+
+    shot = cdp(driver, "Page.captureScreenshot", {
+        "format": "png",
+        "clip": dict(rect, scale=1),
+        "captureBeyondViewport": True,
+    })
+    path = out_dir / f"{name}.png"
+    path.write_bytes(base64.b64decode(shot["data"]))
+    log(f"Область {name}: {path.stat().st_size} байт")
+    return path
+
+
+def make_screenshot(session, dashboard):
+    """
+    Снимает все области дашборда. Возвращает (пути, дорисован ли дашборд);
+    пустой список — ошибка. Не дождались отрисовки — всё равно снимаем, как раньше после sleep.
+    """
+    driver = session.get()
     if not driver:
-        return False
+        return [], False
 
+    url = dashboard["url"]
     try:
-        if COOKIES_PATH.exists():
-            load_cookies(driver)
-
-        log(f"Открываю {DATALENS_URL}")
-        driver.get(DATALENS_URL)
-        log("Жду 20 сек...")
-        time.sleep(20)
-
-        SCREENSHOT_PATH.parent.mkdir(parents=True, exist_ok=True)
-        driver.save_screenshot(str(SCREENSHOT_PATH))
-
-        if SCREENSHOT_PATH.exists():
-            log(f"Скриншот: {SCREENSHOT_PATH.stat().st_size} байт")
-            return True
-        return False
+        if driver.current_url.startswith(url):
+            log(f"Обновляю {url}")
+            driver.refresh()
+        else:
+            log(f"Открываю {url}")
+            driver.get(url)
+        ready = wait_dashboard_ready(driver)
+
+        out_dir = SCREENSHOT_DIR / dashboard["name"]
+        out_dir.mkdir(parents=True, exist_ok=True)
+        shots = [p for p in (capture_region(driver, r, out_dir) for r in dashboard["regions"]) if p]
+        session.save_cookies()
+        return shots, ready
     except Exception as e:
         log(f"Ошибка: {e}")
-        return False
-    finally:
-        driver.quit()
-
-
-def crop_screenshot():
-    try:
-        if not SCREENSHOT_PATH.exists():
+        session.reset()
+        return [], False
+
+
+class TelegramNotifier:
+    """
+    Отправка в Telegram из отдельного потока: одна сессия, очередь,
+    тексты за TG_COALESCE_SEC склеиваются в дайджест по чатам,
+    фото уходят альбомами, на 429 ждём retry_after.
+    on_done(ok) вызывается после отправки.
+    """
+
+    def __init__(self, token):
+        self.token = token
+        self.q = queue.Queue()
+        self.session = requests.Session()
+        self.thread = None
+        self.lock = threading.Lock()
+
+    def send(self, text, chat_id=None, on_done=None):
+        return self.put({"text": text, "chat_id": chat_id or CHAT_ID, "on_done": on_done})
+
+    def send_album(self, paths, caption=None, chat_id=None, on_done=None):
+        return self.put({"photos": list(paths), "caption": caption,
+                         "chat_id": chat_id or CHAT_ID, "on_done": on_done})
+
+    def flush(self, timeout=30):
+        deadline = time.time() + timeout
+        while self.q.unfinished_tasks and time.time() < deadline:
+            time.sleep(0.1)
+
+    def put(self, item):
+        if not self.token or not item["chat_id"]:
             return False
-        img = Image.open(SCREENSHOT_PATH)
-        w, h = img.size
-        cropped = img.crop((0, int(h*0.25), w, int(h*0.55)))
-        cropped.save(SCREENSHOT_PATH)
-        log("Скриншот обрезан")
+        with self.lock:
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.run, name="tg-notifier", daemon=True)
+                self.thread.start()
+        self.q.put(item)
         return True
-    except Exception as e:
-        log(f"Ошибка кропа: {e}")
+
+    def run(self):
+        while True:
+            batch = [self.q.get()]
+            deadline = time.time() + TG_COALESCE_SEC
+            while (left := deadline - time.time()) > 0:
+                try:
+                    batch.append(self.q.get(timeout=left))
+                except queue.Empty:
+                    break
+            try:
+                self.deliver(batch)
+            except Exception as e:
+                log(f"Ошибка отправки в Telegram: {e}")
+            finally:
+                for _ in batch:
+                    self.q.task_done()
+
+    def deliver(self, batch):
+        # Тексты: по одному дайджесту на чат
+        by_chat = {}
+        for item in batch:
+            if "text" in item:
+                by_chat.setdefault(item["chat_id"], []).append(item)
+        for chat_id, items in by_chat.items():
+            ok = all([self.call("sendMessage", {"chat_id": chat_id, "text": chunk})
+                      for chunk in self.digest([i["text"] for i in items])])
+            for i in items:
+                if i["on_done"]:
+                    i["on_done"](ok)
+
+        for item in batch:
+            if "photos" in item:
+                ok = self.album(item["photos"], item["caption"], item["chat_id"])
+                if item["on_done"]:
+                    item["on_done"](ok)
+
+    @staticmethod
+    def digest(texts):
+        chunks, cur = [], ""
+        for t in texts:
+            t = t[:TG_MAX_TEXT]
+            if cur and len(cur) + 2 + len(t) > TG_MAX_TEXT:
+                chunks.append(cur)
+                cur = ""
+            cur = f"{cur}\n\n{t}" if cur else t
+        if cur:
+            chunks.append(cur)
+        return chunks
+
+    def album(self, paths, caption, chat_id):
+        """Альбом (sendMediaGroup, 2–10 фото в сообщении), одиночное фото — sendPhoto."""
+        ok = True
+        for start in range(0, len(paths), 10):
+            chunk = paths[start:start + 10]
+            first_caption = caption if start == 0 and caption else None
+            if len(chunk) == 1:
+                data = {"chat_id": chat_id}
+                if first_caption:
+                    data["caption"] = first_caption
+                ok = self.call("sendPhoto", data, {"photo": chunk[0]}) and ok
+                continue
+            media = []
+            for i in range(len(chunk)):
+                m = {"type": "photo", "media": f"attach://p{i}"}
+                if first_caption and i == 0:
+                    m["caption"] = first_caption
+                media.append(m)
+            ok = self.call("sendMediaGroup", {"chat_id": chat_id, "media": json.dumps(media)},
+                           {f"p{i}": path for i, path in enumerate(chunk)}) and ok
+        return ok
+
+    def call(self, method, data, files=None):
+        url = f"https://api.telegram.org/bot{self.token}/{method}"
+        for attempt in range(1, TG_MAX_RETRIES + 1):
+            handles = {k: open(path, "rb") for k, path in (files or {}).items()}
+            try:
+                r = self.session.post(url, data=data, files=handles or None, timeout=60 if files else 30)
+            except Exception as e:
+                log(f"Telegram {method}: {e}, попытка {attempt}")
+                time.sleep(2 ** attempt)
+                continue
+            finally:
+                for f in handles.values():
+                    f.close()
+
+            if r.status_code == 200:
+                return True
+            if r.status_code == 429 or r.status_code >= 500:
+                try:
+                    delay = r.json().get("parameters", {}).get("retry_after") or 2 ** attempt
+                except ValueError:
+                    delay = 2 ** attempt
+                log(f"Telegram {method}: {r.status_code}, жду {delay} сек")
+                time.sleep(delay)
+                continue
+            log(f"Telegram {method}: {r.status_code} {r.text[:200]}")
+            return False
         return False
 
 
-def send_telegram(text=None, photo_path=None):
-    if not TG_BOT_TOKEN or not CHAT_ID:
-        return False
+NOTIFIER = TelegramNotifier(TG_BOT_TOKEN)
+
+
+def changed_pixels(path, ref_path):
+    """
+    Сколько пикселей заметно поменялось относительно последнего отправленного снимка
+    (None — сравнивать не с чем). Без уменьшения: на дашборде меняются мелкие цифры.
+    """
+    if not ref_path.exists():
+        return None
+    with Image.open(path) as a, Image.open(ref_path) as b:
+        if a.size != b.size:
+            return None
+        diff = ImageChops.difference(a.convert("L"), b.convert("L"))
+    return diff.point(lambda v: 255 if v > PIXEL_TOLERANCE else 0).histogram()[255]
+
+
+class ChangeTracker:
+    """
+    Последние отправленные снимки и время последнего изменения по областям дашборда.
+    «Встал» считаем в отчетах подряд без изменений, а не в часах: ночью отчетов нет,
+    и утренний дашборд без новых данных не должен выглядеть зависшим.
+    """
+
+    def __init__(self, dashboard):
+        self.dir = SCREENSHOT_DIR / dashboard["name"]
+        self.threshold = int(dashboard.get("change_min_pixels", CHANGE_MIN_PIXELS))
+        self.stalled_after = int(dashboard.get("stalled_after_runs", STALLED_AFTER_RUNS))
+        self.state_path = self.dir / "state.json"
+        self.state = {}
+        if self.state_path.exists():
+            try:
+                with open(self.state_path, 'r') as f:
+                    self.state = json.load(f)
+            except Exception as e:
+                log(f"Ошибка чтения {self.state_path}: {e}")
+
+    def split(self, shots):
+        """Делит снимки на изменившиеся и нет."""
+        changed, same = [], []
+        for path in shots:
+            try:
+                pixels = changed_pixels(path, self.sent_path(path))
+            except Exception as e:
+                log(f"Ошибка сравнения {path.name}: {e}")
+                pixels = None
+            if pixels is None or pixels >= self.threshold:
+                changed.append(path)
+            else:
+                same.append(path)
+            log(f"Область {path.stem}: изменилось пикселей {'—' if pixels is None else pixels}")
+        return changed, same
+
+    def sent_path(self, path):
+        return path.with_suffix(".sent" + path.suffix)
+
+    def mark_sent(self, paths):
+        now = time.time()
+        for path in paths:
+            shutil.copyfile(path, self.sent_path(path))
+            self.state[path.stem] = now
+        if paths:
+            self.state.pop("_stalled_notified", None)
+            self.state.pop("_unchanged_runs", None)
+        self.save()
+
+    def mark_unchanged(self):
+        self.state["_unchanged_runs"] = self.state.get("_unchanged_runs", 0) + 1
+        self.save()
+
+    def stalled_since(self):
+        """Время последнего изменения, если дашборд не менялся stalled_after отчетов подряд и об этом ещё не писали."""
+        changes = [v for k, v in self.state.items() if not k.startswith("_")]
+        if not changes or self.state.get("_stalled_notified"):
+            return None
+        return max(changes) if self.state.get("_unchanged_runs", 0) >= self.stalled_after else None
+
+    def mark_stalled_notified(self):
+        self.state["_stalled_notified"] = True
+        self.save()
+
+    def save(self):
+        tmp = self.state_path.with_suffix(".tmp")
+        with open(tmp, 'w') as f:
+            json.dump(self.state, f)
+        os.replace(tmp, self.state_path)
+
+
+def load_dashboards():
+    """Читает список дашбордов; без файла — один DATALENS_URL по старому расписанию."""
+    if DASHBOARDS_PATH.exists():
+        with open(DASHBOARDS_PATH, 'r') as f:
+            dashboards = json.load(f)
+    else:
+        dashboards = [{"name": "obshiy", "url": DATALENS_URL}]
+
+    names = set()
+    for d in dashboards:
+        d.setdefault("cron", DEFAULT_CRON)
+        d.setdefault("regions", REGIONS)
+        d.setdefault("chat_id", CHAT_ID)
+        if not d.get("name") or not d.get("url"):
+            raise ValueError(f"У дашборда нет name/url: {d}")
+        if d["name"] in names:
+            raise ValueError(f"Повтор имени дашборда: {d['name']}")
+        names.add(d["name"])
+    return dashboards
+
+
+def run_report(dashboard, pool):
+    name = dashboard["name"]
+    stamp = now_moscow().strftime("%H:%M")
+    title = dashboard.get("title")
+    prefix = f"{title}. " if title else ""
+
+    log(f"=== Делаю отчет {name} ===")
+    session = pool.acquire()
     try:
-        if photo_path and photo_path.exists():
-            with open(photo_path, "rb") as f:
-                r = requests.post(f"https://api.telegram.org/bot{TG_BOT_TOKEN}/sendPhoto",
-                    data={"chat_id": CHAT_ID}, files={"photo": f}, timeout=30)
-            return r.status_code == 200
-        elif text:
-            r = requests.post(f"https://api.telegram.org/bot{TG_BOT_TOKEN}/sendMessage",
-                data={"chat_id": CHAT_ID, "text": text}, timeout=30)
-            return r.status_code == 200
-    except:
-        return False
+        shots, ready = make_screenshot(session, dashboard)
+    finally:
+        pool.release(session)
+
+    if not shots:
+        NOTIFIER.send(f"{prefix}Ошибка отчета за {stamp}", chat_id=dashboard["chat_id"])
+        return
+
+    if not ready:
+        # Шлём как есть, но эталоном для сравнения недорисованный снимок не делаем
+        NOTIFIER.send_album(shots, caption=f"{prefix}Отчет за {stamp} (дашборд отрисовался не полностью)",
+                            chat_id=dashboard["chat_id"])
+        return
+
+    tracker = ChangeTracker(dashboard)
+    changed, same = tracker.split(shots)
+    if changed:
+        caption = f"{prefix}Отчет за {stamp}"
+        if same:
+            caption += f" (без изменений: {', '.join(p.stem for p in same)})"
+        # Эталон обновляем только после успешной отправки
+        NOTIFIER.send_album(changed, caption=caption, chat_id=dashboard["chat_id"],
+                            on_done=lambda ok: ok and tracker.mark_sent(changed))
+        return
+
+    tracker.mark_unchanged()
+    stalled = tracker.stalled_since()
+    if stalled:
+        since = datetime.fromtimestamp(stalled, timezone.utc) + timedelta(hours=3)
+        NOTIFIER.send(f"{prefix}⚠️ Дашборд не обновлялся с {since.strftime('%d.%m %H:%M')} МСК",
+                      chat_id=dashboard["chat_id"],
+                      on_done=lambda ok: ok and tracker.mark_stalled_notified())
+    elif dashboard.get("unchanged", UNCHANGED_MODE) == "note":
+        NOTIFIER.send(f"{prefix}Отчет за {stamp}: без изменений", chat_id=dashboard["chat_id"])
+    log(f"Дашборд {name} не изменился, снимки не отправлены")
 
 
 def main():
@@ -199,25 +777,29 @@ def main():
         return
 
     log(f"Cookies: {COOKIES_PATH.exists()}")
+    dashboards = load_dashboards()
+    pool = SessionPool(MAX_SESSIONS)
+
+    # Пул потоков = числу сессий: отчёты разных дашбордов идут параллельно, но не больше, чем даёт Grid
+    scheduler = BlockingScheduler(
+        timezone=TIMEZONE,
+        executors={"default": ThreadPoolExecutor(MAX_SESSIONS)},
+        job_defaults={"coalesce": True, "max_instances": 1, "misfire_grace_time": 600},
+    )
+    for d in dashboards:
+        scheduler.add_job(run_report, CronTrigger.from_crontab(d["cron"], timezone=TIMEZONE),
+                          args=(d, pool), id=d["name"], name=d["name"])
+        log(f"Дашборд {d['name']}: {d['cron']} ({len(d['regions'])} обл.)")
+    scheduler.add_job(pool.keepalive, "interval", seconds=KEEPALIVE_SEC, id="keepalive")
 
-    while True:
-        now = now_moscow()
-        next_run = (now + timedelta(hours=1)).replace(minute=10, second=0, microsecond=0)
-        sleep_sec = (next_run - now).total_seconds()
-        log(f"Сплю до {next_run.strftime('%H:%M')} МСК")
-        time.sleep(sleep_sec)
-
-        if now_moscow().hour < 9:
-            continue
-
-        log("=== Делаю отчет ===")
-        if make_screenshot():
-            crop_screenshot()
-            send_telegram(photo_path=SCREENSHOT_PATH)
-            send_telegram(text=f"Отчет за {now_moscow().hour}:00")
-        else:
-            send_telegram(text=f"Ошибка отчета за {now_moscow().hour}:00")
+    try:
+        scheduler.start()
+    except (KeyboardInterrupt, SystemExit):
+        pass
+    finally:
+        pool.close()
+        NOTIFIER.flush()
 
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
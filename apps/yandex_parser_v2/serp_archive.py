@@ -0,0 +1,66 @@
+"""
+Аналитика по локальному архиву выдачи (archive_dir, см. SerpArchive) — без Google Sheets.
+
+    python serp_archive.py sov --from 2025-01-01 --to 2025-01-31     # доля показов по доменам
+    python serp_archive.py history "купить диван" --domain mts.ru      # позиции по запросу во времени
+    python serp_archive.py ads --from 2025-01-01                       # реклама по дням
+    python serp_archive.py sov --csv sov.csv                           # то же в CSV
+
+Даты — YYYY-MM-DD, включительно. Без дат — весь архив.
+"""
+import argparse
+import sys
+
+import pandas as pd
+
+from yandex_parser import CONFIG, SerpArchive
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Запросы к локальному архиву выдачи Яндекса")
+    parser.add_argument("--dir", default=CONFIG.get("archive_dir"), help="папка архива")
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    def add_period(p):
+        p.add_argument("--from", dest="date_from", help="с даты (YYYY-MM-DD)")
+        p.add_argument("--to", dest="date_to", help="по дату (YYYY-MM-DD)")
+        p.add_argument("--csv", help="сохранить результат в CSV")
+
+    p = sub.add_parser("sov", help="share of voice по доменам")
+    add_period(p)
+    p.add_argument("--top", type=int, default=30, help="сколько доменов показать")
+
+    p = sub.add_parser("history", help="история позиций по запросу")
+    p.add_argument("query")
+    p.add_argument("--domain", help="только этот домен")
+    add_period(p)
+
+    p = sub.add_parser("ads", help="количество рекламы по дням")
+    add_period(p)
+
+    args = parser.parse_args()
+    archive = SerpArchive(args.dir)
+
+    if args.command == "sov":
+        df = archive.share_of_voice(args.date_from, args.date_to)
+        shown = df.head(args.top)
+    elif args.command == "history":
+        df = archive.position_history(args.query, args.date_from, args.date_to, domain=args.domain)
+        shown = df
+    else:
+        df = archive.ad_counts(args.date_from, args.date_to)
+        shown = df
+
+    if args.csv:
+        df.to_csv(args.csv, index=args.command == "history")
+        print(f"Сохранено {len(df)} строк в {args.csv}")
+    if df.empty:
+        print("В архиве нет данных за этот период")
+        return 1
+    with pd.option_context("display.width", 200, "display.max_columns", 50, "display.float_format", "{:.3f}".format):
+        print(shown.to_string(index=args.command == "history"))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,123 @@
+"""
+Офлайн-проверка и бенчмарк HTML-парсера выдачи.
+
+    python serp_bench.py                      # сверка с эталонами + замер скорости
+    python serp_bench.py --iterations 500     # длиннее замер
+    python serp_bench.py /app/data/serp_html  # замер на реальных страницах (save_serp_html)
+    python serp_bench.py --dump /app/data/serp_html   # перепарсить сохранённые страницы
+
+Эталон для страницы name.html лежит рядом в name.expected.json.
+
+serp_fixtures — синтетические страницы на 1–4 КБ: минимальная разметка блоков
+выдачи для сверки парсера с эталонами. Настоящая выдача весит сотни КБ, так что
+скорость и память на фикстурах годятся только для сравнения версий парсера между
+собой; для абсолютных цифр запускайте замер на папке с сохранёнными страницами
+(CONFIG["save_serp_html"] = True).
+"""
+import argparse
+import glob
+import json
+import os
+import sys
+import time
+import tracemalloc
+
+from yandex_parser import parse_ads_from_html
+
+FIXTURES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "serp_fixtures")
+
+
+def load_pages(directory):
+    pages = []
+    for path in sorted(glob.glob(os.path.join(directory, "*.html"))):
+        with open(path, encoding="utf-8") as f:
+            pages.append((path, f.read()))
+    return pages
+
+
+def check_expected(pages):
+    """Сверяет результат парсинга с name.expected.json. Возвращает число расхождений."""
+    failures = 0
+    for path, page_html in pages:
+        expected_path = path[:-len(".html")] + ".expected.json"
+        if not os.path.exists(expected_path):
+            continue
+        with open(expected_path, encoding="utf-8") as f:
+            expected = json.load(f)
+        got = parse_ads_from_html(page_html)
+        if got != expected:
+            failures += 1
+            print(f"FAIL {os.path.basename(path)}")
+            print(f"  ожидали: {json.dumps(expected, ensure_ascii=False)}")
+            print(f"  получили: {json.dumps(got, ensure_ascii=False)}")
+        else:
+            print(f"ok   {os.path.basename(path)} ({len(got)} рекламных позиций)")
+    return failures
+
+
+def bench(pages, iterations):
+    # Прогрев: первые вызовы платят за импорт и кэши lxml
+    for _, page_html in pages:
+        parse_ads_from_html(page_html)
+
+    started = time.perf_counter()
+    for _ in range(iterations):
+        for _, page_html in pages:
+            parse_ads_from_html(page_html)
+    elapsed = time.perf_counter() - started
+    parsed = iterations * len(pages)
+
+    # Аллокации считаем отдельным проходом: tracemalloc сам по себе замедляет парсинг.
+    # libxml2 выделяет память в C, поэтому здесь видны только Python-объекты.
+    peaks, blocks = [], []
+    tracemalloc.start()
+    for _, page_html in pages:
+        before = tracemalloc.take_snapshot()
+        tracemalloc.reset_peak()
+        base, _ = tracemalloc.get_traced_memory()
+        parse_ads_from_html(page_html)
+        _, peak = tracemalloc.get_traced_memory()
+        diff = tracemalloc.take_snapshot().compare_to(before, "filename")
+        peaks.append(peak - base)
+        blocks.append(sum(stat.count_diff for stat in diff if stat.count_diff > 0))
+    tracemalloc.stop()
+
+    print(f"страниц: {len(pages)}, итераций: {iterations}")
+    print(f"скорость: {parsed / elapsed:.1f} стр/сек ({elapsed / parsed * 1000:.2f} мс/стр)")
+    print(f"пик Python-памяти на страницу: {sum(peaks) / len(peaks) / 1024:.1f} КБ (макс {max(peaks) / 1024:.1f} КБ)")
+    print(f"новых Python-блоков на страницу: {sum(blocks) / len(blocks):.0f}")
+
+
+def dump(pages):
+    """Перепарсивает страницы и печатает записи в JSON Lines."""
+    for path, page_html in pages:
+        for record in parse_ads_from_html(page_html):
+            record = dict(record, file=os.path.basename(path))
+            print(json.dumps(record, ensure_ascii=False))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Офлайн-бенчмарк парсера выдачи Яндекса")
+    parser.add_argument("directory", nargs="?", default=FIXTURES_DIR, help="папка с *.html")
+    parser.add_argument("--iterations", type=int, default=200)
+    parser.add_argument("--dump", action="store_true", help="только распарсить и вывести записи")
+    args = parser.parse_args()
+
+    pages = load_pages(args.directory)
+    if not pages:
+        print(f"В {args.directory} нет *.html")
+        return 1
+
+    if args.dump:
+        dump(pages)
+        return 0
+
+    failures = check_expected(pages)
+    if os.path.abspath(args.directory) == FIXTURES_DIR:
+        print("фикстуры синтетические — цифры ниже не отражают реальную выдачу, только сравнение версий")
+    bench(pages, args.iterations)
+    return 1 if failures else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
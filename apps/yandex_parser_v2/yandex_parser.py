@@ -1,19 +1,28 @@
 import os
 import re
+import atexit
+import base64
+import contextlib
+import glob
 import time
 import json
 import tempfile
 import urllib.parse
 import random
+import queue
+import sqlite3
+import threading
+import zlib
 from datetime import datetime, time as dtime, timedelta
 try:
     from zoneinfo import ZoneInfo
 except ImportError:
     from backports.zoneinfo import ZoneInfo
 
-from urllib.parse import urlparse
+from urllib.parse import urlparse, urljoin
 import requests
 import pandas as pd
+from lxml import etree, html as lxml_html
 
 from selenium.common.exceptions import TimeoutException as SelTimeoutException
 from selenium import webdriver
@@ -30,6 +39,7 @@ from googleapiclient.http import MediaFileUpload
 from google_auth_oauthlib.flow import InstalledAppFlow
 from google.auth.transport.requests import Request
 from google.oauth2.credentials import Credentials as UserCredentials
+from prometheus_client import Counter, Gauge, Histogram, start_http_server
 
 # Логирование
 def log(msg):
@@ -53,6 +63,33 @@ CONFIG = {
     "gsheets_results_spreadsheet_id": "1EEXVYmlDFPiCn4hcDVdDon9PrQJbcPP7P-2y4i6PknA",
     "gsheets_results_sheet": "Results",
 
+    # Запись в Results пачками: буфер в памяти + спул на диске
+    "results_flush_rows": 50,               # сбрасываем, когда накопилось столько строк
+    "results_flush_interval_sec": 60,       # ...или когда самая старая строка ждёт дольше
+    "sheets_writes_per_minute": 50,         # квота Sheets — 60 записей/мин, держим запас
+    "sheets_max_retries": 5,                # ретраи на 429/5xx/сетевые ошибки
+    "results_spool_path": "/app/data/results_spool.jsonl",
+    "results_deadletter_path": "/app/data/results_deadletter.jsonl",  # пачки, которые Sheets отверг (400/403)
+    "results_max_backoff_sec": 600,         # потолок паузы между сбросами после неудачи
+
+    # Журнал прогонов для продолжения после рестарта
+    "run_journal_path": "/app/data/run_journal.sqlite3",
+
+    # Дубликаты запросов («Купить Диван» = «диван  купить») парсим один раз
+    "query_dedup": True,
+    "result_cache_ttl_sec": 6 * 3600,       # и повтор в пределах TTL берём из кэша (в своём окне — всегда; в continuous — только в своём окне)
+
+    # Локальный архив выдачи (SQLite по месяцам) для аналитики без Sheets — см. serp_archive.py
+    "archive_enabled": True,
+    "archive_dir": "/app/data/archive",
+
+    # Расписание. "continuous" — каждый запрос со своей частотой из колонки C,
+    # равномерно по активным часам недели; "burst" — весь список пн и пт в 10:00 МСК
+    "schedule_mode": "continuous",
+    "schedule_tick_min": 30,                # как часто забираем подошедшие запросы
+    "schedule_active_hours": (9, 22),       # МСК; ночью не парсим
+    "default_query_frequency": "2/w",       # пустая колонка C — как раньше, два раза в неделю
+
     # Excel (если queries_source == "excel")
     "excel_path": "queries.xlsx",
     "excel_sheet_name": "Sheet1",
@@ -74,10 +111,29 @@ CONFIG = {
     "captcha_backoff_sec": [120, 300],      # бэкофф между ретраями (2 и 5 минут)
     "max_retries_per_query": 3,             # попыток на один запрос
 
+    # Адаптивные паузы (AIMD): без капч пауза плавно сокращается,
+    # после капчи — резко растёт. Состояние переживает перезапуски.
+    "adaptive_pacing": True,
+    "pacing_min_pause_sec": 15,
+    "pacing_max_pause_sec": 240,
+    "pacing_decrease_step_sec": 3,          # на столько сокращаем паузу после серии без капч
+    "pacing_calm_streak": 3,                # ...длиной в столько запросов
+    "pacing_captcha_factor": 2.0,           # во столько раз растёт пауза после капчи
+    "pacing_state_path": "/app/data/pacing_state.json",
+
+    # Пул браузеров: прогретые Chrome живут между запросами
+    "driver_pool_size": 1,                  # сколько браузеров держим одновременно
+    "driver_max_uses": 20,                  # после стольких запросов браузер пересоздаётся
+
+    # Параллельные сессии: у каждой свой браузер, файл cookies, UA и паузы.
+    # Каждый Chrome съедает 400–600 МБ — следи за лимитом памяти контейнера.
+    "parallel_sessions": 1,
+
     # Капча: ручной режим + ожидание
     "manual_captcha_mode": True,            # ждём пользователя для прохождения
     "manual_captcha_total_wait_sec": 300,   # ждём до 5 минут
-    "manual_captcha_poll_sec": 2,           # проверяем каждые 2 сек
+    "manual_captcha_poll_sec": 2,           # пауза перед повторной проверкой после перехода страницы
+    "manual_captcha_watch_sec": 30,         # сколько держим MutationObserver за один вызов
 
     # Ротация UA
     "rotate_user_agents": [
@@ -86,54 +142,99 @@ CONFIG = {
         "Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/605.1.15 (KHTML, like Gecko) Version/17.0 Safari/605.1.15",
     ],
 
+    # HTTP-first: сначала пробуем выдачу обычным GET с cookies из cookies_path,
+    # браузер поднимаем только при капче или непарсибельной странице.
+    # Скриншота у таких запросов нет — колонка screenshot остаётся пустой.
+    "http_first": False,
+    "http_timeout_sec": 15,
+
     # Парсинг рекламных меток
     "ad_labels": ["Реклама", "Промо"],
     "top_n": 5,
 
+    # Фоновая загрузка скриншотов на Drive
+    "drive_upload_workers": 2,
+    "drive_upload_retries": 3,
+    "drive_queue_path": "/app/data/drive_queue.json",
+    "drive_final_wait_sec": 300,            # сколько ждём загрузки при финальном сбросе Results
+
     # Google Service Account (для Sheets)
     "google_sa_json_path": "service_account.json",
+    "google_cache_ttl_sec": 600,            # кэш хэндлов таблиц/листов и метаданных
+
+    # Telegram
+    "tg_coalesce_sec": 3.0,                 # сообщения за это окно уходят одним дайджестом
+    "tg_max_retries": 5,
+
+    # Prometheus
+    "metrics_port": 9108,
     "cookies_path": "/app/data/yandex_search_cookies.json",
-    "screenshot_dir": "/app/data/screenshots"
+    "screenshot_dir": "/app/data/screenshots",
+
+    # Скриншоты: "top" — только первые результаты, "full" — вся страница, "viewport" — экран
+    "screenshot_mode": "top",
+    "screenshot_top_results": 5,            # сколько блоков выдачи попадает в "top"
+    "screenshot_format": "webp",            # webp | jpeg | png
+    "screenshot_quality": 70,               # для webp/jpeg
+    "screenshot_scale": 0.75,               # даунскейл (1.0 — без изменений)
+    "screenshot_keep_days": 14,             # локальные файлы старше — удаляем
+    "screenshot_max_files": 2000,           # и не держим больше стольких
+
+    # Сохранять HTML выдачи для офлайн-перепарсинга (serp_bench.py --dump)
+    "save_serp_html": False,
+    "serp_html_dir": "/app/data/serp_html",
 }
 
+# Метрики Prometheus (/metrics на CONFIG["metrics_port"])
+STAGE_SECONDS = Histogram(
+    "yandex_parser_stage_seconds", "Длительность этапов обработки запроса", ["stage"],
+    buckets=(0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 30, 60, 120),
+)
+CAPTCHAS = Counter("yandex_parser_captchas_total", "Сколько раз встретили капчу")
+RETRIES = Counter("yandex_parser_retries_total", "Повторные попытки запросов")
+TIMEOUTS = Counter("yandex_parser_timeouts_total", "Таймауты", ["kind"])
+ADS_FOUND = Counter("yandex_parser_ads_found_total", "Найдено рекламных позиций")
+QUERIES_TOTAL = Gauge("yandex_parser_queries_total", "Запросов в текущем прогоне")
+QUERIES_PROCESSED = Gauge("yandex_parser_queries_processed", "Обработано запросов в текущем прогоне")
+QUERIES_FINISHED = Counter("yandex_parser_queries_finished_total", "Завершённые запросы", ["status"])
+PACING_PAUSE = Gauge("yandex_parser_pacing_pause_seconds", "Текущая базовая пауза между запросами")
+LAST_RUN_FINISHED = Gauge("yandex_parser_last_run_finished_timestamp_seconds", "Когда закончился последний прогон")
+
+
+def start_metrics_server():
+    port = int(os.environ.get("METRICS_PORT", CONFIG.get("metrics_port", 9108)))
+    try:
+        start_http_server(port)
+        log(f"[METRICS] /metrics на порту {port}")
+    except Exception as e:
+        log(f"[METRICS] Не удалось поднять /metrics: {e}")
+
 DOMAIN_RE = re.compile(r'(?i)\b([a-z0-9-]+\.)+[a-z]{2,}\b')
 
 def extract_display_domain(block):
     """
     Достаёт видимый домен из результата Яндекса (например: mts.ru).
-    Работает без клика, по тексту внутри блока результата.
+    Работает без клика, по снимку блока результата (см. snapshot_serp_blocks).
     """
     # 1) Пытаемся вытащить из "строки адреса/пути" (обычно там 'mts.ru › ...')
-    xps = [
-        ".//*[contains(@class,'Path') or contains(@class,'path')]",
-        ".//*[contains(@class,'Organic-Path') or contains(@class,'organic__path')]",
-        ".//*[contains(@class,'Link') and contains(@class,'Path')]",
-    ]
-    for xp in xps:
-        try:
-            for el in block.find_elements(By.XPATH, xp):
-                txt = (el.text or "").strip()
-                if not txt:
-                    continue
-                txt = txt.replace("›", " ").replace("·", " ")
-                m = DOMAIN_RE.search(txt)
-                if m:
-                    return m.group(0).lower()
-        except Exception:
-            pass
-
-    # 2) Fallback: берём только верхние строки блока (чтобы не ловить мусор)
-    try:
-        txt = (block.text or "").strip()
+    for txt in block.get("path_texts") or []:
+        txt = (txt or "").strip()
         if not txt:
-            return None
-        head = "\n".join(txt.splitlines()[:6])  # первые строки сниппета
-        head = head.replace("›", " ").replace("·", " ")
-        m = DOMAIN_RE.search(head)
+            continue
+        txt = txt.replace("›", " ").replace("·", " ")
+        m = DOMAIN_RE.search(txt)
         if m:
             return m.group(0).lower()
-    except Exception:
-        pass
+
+    # 2) Fallback: берём только верхние строки блока (чтобы не ловить мусор)
+    txt = (block.get("text") or "").strip()
+    if not txt:
+        return None
+    head = "\n".join(txt.splitlines()[:6])  # первые строки сниппета
+    head = head.replace("›", " ").replace("·", " ")
+    m = DOMAIN_RE.search(head)
+    if m:
+        return m.group(0).lower()
 
     return None
 
@@ -144,70 +245,299 @@ SHEETS_SCOPES = [
     "https://www.googleapis.com/auth/drive.file",
 ]
 
-def send_telegram(text):
-    """Отправляет сообщение в Telegram."""
-    if not TG_BOT_TOKEN or not TG_CHAT_ID:
-        log("[TG] Токен или chat_id не заданы")
-        return False
-    try:
-        r = requests.post(
-            f"https://api.telegram.org/bot{TG_BOT_TOKEN}/sendMessage",
-            data={"chat_id": TG_CHAT_ID, "text": text},
-            timeout=10
-        )
-        return r.status_code == 200
-    except Exception as e:
-        log(f"[TG] Ошибка отправки: {e}")
+TG_MAX_TEXT = 4096
+
+
+class TelegramNotifier:
+    """
+    Уведомления в Telegram в фоне: постоянная сессия, очередь, склейка
+    сообщений за окно tg_coalesce_sec в один дайджест, несколько фото —
+    альбомом, на 429 ждём retry_after. Отправка не тормозит парсинг.
+    """
+
+    def __init__(self, token, chat_id):
+        self.token = token
+        self.chat_id = chat_id
+        self._q = queue.Queue()
+        self._session = requests.Session()
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def send(self, text):
+        return self._put({"text": text})
+
+    def send_photo(self, photo_path, caption=None):
+        return self._put({"photo": photo_path, "caption": caption})
+
+    def flush(self, timeout=30):
+        """Ждём, пока очередь разойдётся (например, перед выходом)."""
+        deadline = time.time() + timeout
+        while self._q.unfinished_tasks and time.time() < deadline:
+            time.sleep(0.1)
+        return not self._q.unfinished_tasks
+
+    def _put(self, item):
+        if not self.token or not self.chat_id:
+            log("[TG] Токен или chat_id не заданы")
+            return False
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="tg-notifier", daemon=True)
+                self._thread.start()
+        self._q.put(item)
+        return True
+
+    def _run(self):
+        while True:
+            batch = [self._q.get()]
+            deadline = time.time() + CONFIG.get("tg_coalesce_sec", 3.0)
+            while (left := deadline - time.time()) > 0:
+                try:
+                    batch.append(self._q.get(timeout=left))
+                except queue.Empty:
+                    break
+            try:
+                self._deliver(batch)
+            except Exception as e:
+                log(f"[TG] Ошибка отправки: {e}")
+            finally:
+                for _ in batch:
+                    self._q.task_done()
+
+    def _deliver(self, batch):
+        texts = [i["text"] for i in batch if "text" in i]
+        photos = [i for i in batch if "photo" in i]
+
+        for chunk in self._digest(texts):
+            self._call("sendMessage", {"chat_id": self.chat_id, "text": chunk})
+
+        for start in range(0, len(photos), 10):
+            group = photos[start:start + 10]
+            if len(group) == 1:
+                p = group[0]
+                data = {"chat_id": self.chat_id}
+                if p["caption"]:
+                    data["caption"] = p["caption"][:1024]
+                self._call("sendPhoto", data, {"photo": p["photo"]})
+                continue
+            media = []
+            for i, p in enumerate(group):
+                item = {"type": "photo", "media": f"attach://p{i}"}
+                if p["caption"]:
+                    item["caption"] = p["caption"][:1024]
+                media.append(item)
+            self._call("sendMediaGroup", {"chat_id": self.chat_id, "media": json.dumps(media)},
+                       {f"p{i}": p["photo"] for i, p in enumerate(group)})
+
+    @staticmethod
+    def _digest(texts):
+        """Склеивает сообщения в куски не длиннее лимита Telegram."""
+        chunks, cur = [], ""
+        for t in texts:
+            t = t[:TG_MAX_TEXT]
+            if cur and len(cur) + 2 + len(t) > TG_MAX_TEXT:
+                chunks.append(cur)
+                cur = ""
+            cur = f"{cur}\n\n{t}" if cur else t
+        if cur:
+            chunks.append(cur)
+        return chunks
+
+    def _call(self, method, data, files=None):
+        url = f"https://api.telegram.org/bot{self.token}/{method}"
+        for attempt in range(1, CONFIG.get("tg_max_retries", 5) + 1):
+            handles = {k: open(path, "rb") for k, path in (files or {}).items()}
+            try:
+                r = self._session.post(url, data=data, files=handles or None, timeout=60 if files else 10)
+            except Exception as e:
+                log(f"[TG] {method}: {e}, попытка {attempt}")
+                time.sleep(2 ** attempt)
+                continue
+            finally:
+                for f in handles.values():
+                    f.close()
+
+            if r.status_code == 200:
+                return True
+            if r.status_code == 429 or r.status_code >= 500:
+                try:
+                    delay = r.json().get("parameters", {}).get("retry_after") or 2 ** attempt
+                except ValueError:
+                    delay = 2 ** attempt
+                log(f"[TG] {method}: {r.status_code}, жду {delay} сек")
+                time.sleep(delay)
+                continue
+            log(f"[TG] {method}: {r.status_code} {r.text[:200]}")
+            return False
         return False
 
+
+NOTIFIER = TelegramNotifier(TG_BOT_TOKEN, TG_CHAT_ID)
+atexit.register(NOTIFIER.flush)
+
+
+def send_telegram(text):
+    """Ставит сообщение в очередь Telegram."""
+    return NOTIFIER.send(text)
+
 def send_telegram_photo(photo_path, caption=None):
     """Sends photo to tg"""
-    if not TG_BOT_TOKEN or not TG_CHAT_ID:
-        return False
-    try:
-        with open(photo_path, "rb") as f:
-            data = {"chat_id": TG_CHAT_ID}
-            if caption:
-                data["caption"] = caption
-            r = requests.post(
-                f"https://api.telegram.org/bot{TG_BOT_TOKEN}/sendPhoto",
-                data=data,
-                files={"photo": f},
-                timeout=30
-            )
-        return r.status_code == 200
-    except Exception as e:
-        log(f"[TG] Ошибка отправки фоточки: {e}")
-        return False
+    return NOTIFIER.send_photo(photo_path, caption)
+
+class CookieStore:
+    """
+    Файл cookies в формате driver.get_cookies(), проиндексированный по домену.
+    Пишется атомарно (tmp + rename) и только если что-то поменялось,
+    просроченные cookies выкидываются. В браузер cookies уходят одним вызовом
+    CDP Network.setCookies — без перехода на каждый домен и без sleep.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._by_domain = {}        # domain -> {(name, path): cookie}
+        self._dirty = False
+        self._load()
+
+    def __len__(self):
+        with self._lock:
+            return sum(len(v) for v in self._by_domain.values())
+
+    def cookies(self):
+        with self._lock:
+            self._prune()
+            return [c for bucket in self._by_domain.values() for c in bucket.values()]
+
+    def update(self, cookies):
+        """Вливает cookies из браузера. Возвращает True, если что-то поменялось."""
+        changed = False
+        with self._lock:
+            for c in cookies:
+                if not c.get("name"):
+                    continue
+                bucket = self._by_domain.setdefault(c.get("domain", ""), {})
+                key = (c["name"], c.get("path", "/"))
+                if bucket.get(key) != c:
+                    bucket[key] = dict(c)
+                    changed = True
+            changed = self._prune() or changed
+            self._dirty = self._dirty or changed
+        return changed
+
+    def save(self):
+        """Атомарно пишет файл, если были изменения. Возвращает True, если писали."""
+        with self._lock:
+            if not self._dirty:
+                return False
+            cookies = [c for bucket in self._by_domain.values() for c in bucket.values()]
+            os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+            tmp = f"{self.path}.{os.getpid()}.{threading.get_ident()}.tmp"
+            with open(tmp, "w") as f:
+                json.dump(cookies, f)
+            os.replace(tmp, self.path)
+            self._dirty = False
+            return True
+
+    def inject(self, driver):
+        """Кладёт все cookies в браузер одним CDP-вызовом. Возвращает их число."""
+        params = [self._to_cdp(c) for c in self.cookies()]
+        if params:
+            driver.execute_cdp_cmd("Network.setCookies", {"cookies": params})
+        return len(params)
+
+    @staticmethod
+    def _to_cdp(c):
+        out = {
+            "name": c["name"],
+            "value": c.get("value", ""),
+            "domain": c.get("domain", ""),
+            "path": c.get("path", "/"),
+            "secure": bool(c.get("secure", False)),
+            "httpOnly": bool(c.get("httpOnly", False)),
+        }
+        if c.get("sameSite") in ("Strict", "Lax", "None"):
+            out["sameSite"] = c["sameSite"]
+        if c.get("expiry"):
+            out["expires"] = c["expiry"]
+        return out
+
+    def _prune(self):
+        now = time.time()
+        removed = False
+        for domain in list(self._by_domain):
+            bucket = self._by_domain[domain]
+            for key in [k for k, c in bucket.items() if c.get("expiry") and c["expiry"] < now]:
+                del bucket[key]
+                removed = True
+            if not bucket:
+                del self._by_domain[domain]
+        self._dirty = self._dirty or removed
+        return removed
+
+    def _load(self):
+        if not os.path.exists(self.path):
+            return
+        try:
+            with open(self.path, "r") as f:
+                cookies = json.load(f)
+        except Exception as e:
+            log(f"[COOKIES] Не удалось прочитать {self.path}: {e}")
+            return
+        with self._lock:
+            for c in cookies:
+                if c.get("name"):
+                    self._by_domain.setdefault(c.get("domain", ""), {})[(c["name"], c.get("path", "/"))] = c
+            # если при загрузке что-то протухло — файл перепишется при следующем save()
+            self._dirty = self._prune()
+
+
+_cookie_stores = {}
+_cookie_stores_lock = threading.Lock()
 
-def save_cookies(driver):
-    """Сохраняет cookies в файл."""
+
+def cookie_store(cookies_path=None):
+    """Один CookieStore на файл на весь процесс."""
+    cookies_path = cookies_path or CONFIG["cookies_path"]
+    with _cookie_stores_lock:
+        store = _cookie_stores.get(cookies_path)
+        if store is None:
+            store = _cookie_stores[cookies_path] = CookieStore(cookies_path)
+        return store
+
+
+def save_cookies(driver, cookies_path=None):
+    """Сохраняет cookies в файл (только если они изменились)."""
     try:
-        cookies = driver.get_cookies()
-        cookies_path = CONFIG["cookies_path"]
-        os.makedirs(os.path.dirname(cookies_path), exist_ok=True)
-        with open(cookies_path, 'w') as f:
-            json.dump(cookies, f)
-        log(f"[COOKIES] Сохранено {len(cookies)} cookies")
+        store = cookie_store(cookies_path)
+        store.update(driver.get_cookies())
+        if store.save():
+            log(f"[COOKIES] Сохранено {len(store)} cookies")
         return True
     except Exception as e:
         log(f"[COOKIES] Ошибка сохранения: {e}")
         return False
 
-def load_cookies(driver):
+def load_cookies(driver, cookies_path=None):
     """Загружает кукисы из файлика"""
-    cookies_path = CONFIG["cookies_path"]
-    if not os.path.exists(cookies_path):
+    store = cookie_store(cookies_path)
+    if not len(store):
         log("[COOKIES] файл не найден(-ы)")
         return False
     try:
-        with open(cookies_path, 'r') as f:
-            cookies = json.load(f)
+        loaded = store.inject(driver)
+        log(f"[COOKIES] Загружено {loaded} куки")
+        return True
+    except Exception as e:
+        log(f"[COOKIES] CDP недоступен ({e}), загружаю по одной")
+
+    # Фолбэк без CDP: add_cookie работает только для открытого домена
+    try:
         driver.get("https://ya.ru")
         time.sleep(2)
 
         loaded = 0
-        for cookie in cookies:
+        for cookie in store.cookies():
+            cookie = dict(cookie)
             cookie.pop('sameSite', None)
             cookie.pop('expiry', None)
             try:
@@ -222,32 +552,117 @@ def load_cookies(driver):
         log(f"[COOKIES] Ошибка загрузки куки: {e}")
         return False
 
-def get_google_creds():
-    return Credentials.from_service_account_file(CONFIG["google_sa_json_path"], scopes=SHEETS_SCOPES)
+class GoogleClients:
+    """
+    Реестр Google-клиентов на весь процесс: каждый клиент создаётся один раз,
+    токены обновляются заранее (до истечения), а HTTP-соединения переиспользуются.
+    Хэндлы таблиц/листов и проверки метаданных кэшируются на google_cache_ttl_sec.
+    """
 
-def gsheet_client():
-    return gspread.authorize(get_google_creds())
+    # Обновляем токен, если до истечения осталось меньше этого
+    REFRESH_MARGIN = timedelta(minutes=5)
+
+    def __init__(self):
+        self._lock = threading.RLock()
+        self._sa_creds = None
+        self._user_creds = None
+        self._gspread = None
+        self._drive = None
+        self._cache = {}
+        # Общая requests-сессия для обновления токенов — keep-alive до oauth2.googleapis.com
+        self._auth_request = Request(session=requests.Session())
+
+    def sa_creds(self):
+        with self._lock:
+            if self._sa_creds is None:
+                self._sa_creds = Credentials.from_service_account_file(
+                    CONFIG["google_sa_json_path"], scopes=SHEETS_SCOPES
+                )
+            self._refresh_if_needed(self._sa_creds)
+            return self._sa_creds
+
+    def user_drive_creds(self):
+        with self._lock:
+            if self._user_creds is None:
+                self._user_creds = _load_user_drive_creds(self._auth_request)
+            elif self._refresh_if_needed(self._user_creds):
+                _save_user_drive_creds(self._user_creds)
+            return self._user_creds
+
+    def gspread(self):
+        with self._lock:
+            creds = self.sa_creds()
+            if self._gspread is None:
+                self._gspread = gspread.authorize(creds)
+            return self._gspread
+
+    def drive(self):
+        """Drive-клиент сервисного аккаунта (только для главного потока — httplib2 не потокобезопасен)."""
+        with self._lock:
+            creds = self.sa_creds()
+            if self._drive is None:
+                self._drive = build("drive", "v3", credentials=creds, cache_discovery=False)
+            return self._drive
+
+    def cached(self, key, factory, ttl=None):
+        ttl = CONFIG.get("google_cache_ttl_sec", 600) if ttl is None else ttl
+        with self._lock:
+            hit = self._cache.get(key)
+            if hit and hit[0] > time.monotonic():
+                return hit[1]
+        value = factory()
+        with self._lock:
+            self._cache[key] = (time.monotonic() + ttl, value)
+        return value
+
+    def spreadsheet(self, spreadsheet_id):
+        return self.cached(("spreadsheet", spreadsheet_id), lambda: self.gspread().open_by_key(spreadsheet_id))
+
+    def _refresh_if_needed(self, creds):
+        expiry = getattr(creds, "expiry", None)
+        if creds.valid and (not expiry or expiry - datetime.utcnow() > self.REFRESH_MARGIN):
+            return False
+        creds.refresh(self._auth_request)
+        return True
 
-def get_user_drive_creds():
+
+def _load_user_drive_creds(request):
     token_path = "token_drive.json"
     creds = None
     if os.path.exists(token_path):
         creds = UserCredentials.from_authorized_user_file(token_path, DRIVE_OAUTH_SCOPES)
     if not creds or not creds.valid:
         if creds and creds.expired and creds.refresh_token:
-            creds.refresh(Request())
+            creds.refresh(request)
         else:
             flow = InstalledAppFlow.from_client_secrets_file("oauth_client.json", DRIVE_OAUTH_SCOPES)
             creds = flow.run_local_server(port=0)
-        with open(token_path, "w", encoding="utf-8") as f:
-            f.write(creds.to_json())
+        _save_user_drive_creds(creds)
     return creds
 
-def upload_to_drive(local_path, filename):
+
+def _save_user_drive_creds(creds):
+    with open("token_drive.json", "w", encoding="utf-8") as f:
+        f.write(creds.to_json())
+
+
+GOOGLE = GoogleClients()
+
+def get_google_creds():
+    return GOOGLE.sa_creds()
+
+def gsheet_client():
+    return GOOGLE.gspread()
+
+def get_user_drive_creds():
+    return GOOGLE.user_drive_creds()
+
+@STAGE_SECONDS.labels("drive_upload").time()
+def upload_to_drive(local_path, filename, drive=None):
     try:
-        drive = build("drive", "v3", credentials=get_user_drive_creds())
+        drive = drive or build("drive", "v3", credentials=get_user_drive_creds())
         file_metadata = {"name": filename, "parents": [CONFIG["gdrive_folder_id"]]}
-        media = MediaFileUpload(local_path, mimetype="image/png", resumable=True)
+        media = MediaFileUpload(local_path, mimetype=screenshot_mimetype(local_path), resumable=True)
         file = drive.files().create(body=file_metadata, media_body=media,
                                     fields="id,webViewLink").execute()
         return file["id"], file.get("webViewLink")
@@ -256,44 +671,470 @@ def upload_to_drive(local_path, filename):
         return None, None
 
 def assert_is_google_sheet(spreadsheet_id):
-    creds = get_google_creds()
-    drive = build("drive", "v3", credentials=creds)
-    meta = drive.files().get(fileId=spreadsheet_id, fields="id, name, mimeType").execute()
+    meta = GOOGLE.cached(
+        ("file_meta", spreadsheet_id),
+        lambda: GOOGLE.drive().files().get(fileId=spreadsheet_id, fields="id, name, mimeType").execute(),
+    )
     if meta["mimeType"] != "application/vnd.google-apps.spreadsheet":
         raise ValueError(
             f"Документ '{meta['name']}' не является Google Таблицей "
             f"(mimeType={meta['mimeType']}). Конвертируй: Файл → Сохранить как Google Таблицы."
         )
 
-def ensure_results_worksheet(gc):
-    assert_is_google_sheet(CONFIG["gsheets_results_spreadsheet_id"])
-    sh = gc.open_by_key(CONFIG["gsheets_results_spreadsheet_id"])
-    try:
-        ws = sh.worksheet(CONFIG["gsheets_results_sheet"])
-    except gspread.exceptions.WorksheetNotFound:
-        ws = sh.add_worksheet(CONFIG["gsheets_results_sheet"], rows=1000, cols=10)
-        ws.append_row(["timestamp", "query", "position", "label", "title", "url", "domain"])
-    return ws
+def ensure_results_worksheet():
+    spreadsheet_id = CONFIG["gsheets_results_spreadsheet_id"]
+    assert_is_google_sheet(spreadsheet_id)
 
-def read_queries():
+    def open_ws():
+        sh = GOOGLE.spreadsheet(spreadsheet_id)
+        try:
+            ws = sh.worksheet(CONFIG["gsheets_results_sheet"])
+        except gspread.exceptions.WorksheetNotFound:
+            ws = sh.add_worksheet(CONFIG["gsheets_results_sheet"], rows=1000, cols=10)
+            ws.append_row(["timestamp", "query", "position", "label", "title", "url", "domain", "screenshot"])
+            return ws
+        # Листы со старой 7-колоночной шапкой: подписываем колонку со ссылками на скриншоты
+        if not ws.acell("H1").value:
+            ws.update_acell("H1", "screenshot")
+        return ws
+
+    return GOOGLE.cached(("worksheet", spreadsheet_id, CONFIG["gsheets_results_sheet"]), open_ws)
+
+def read_query_rows():
+    """[(запрос, частота)] — колонка B и необязательная колонка C рядом с ней."""
     if CONFIG.get("queries_source") == "excel":
         df = pd.read_excel(CONFIG["excel_path"], sheet_name=CONFIG["excel_sheet_name"])
         col_idx = ord(CONFIG["excel_column"].upper()) - ord('A')
-        return [str(x).strip() for x in df.iloc[:, col_idx].dropna().tolist() if str(x).strip()]
+        rows = []
+        for _, r in df.iterrows():
+            q = r.iloc[col_idx]
+            if pd.isna(q) or not str(q).strip():
+                continue
+            freq = r.iloc[col_idx + 1] if col_idx + 1 < len(r) else None
+            rows.append((str(q).strip(), "" if pd.isna(freq) else str(freq).strip()))
+        return rows
     else:
-        gc = gsheet_client()
-        sh = gc.open_by_key(CONFIG["gsheets_queries_spreadsheet_id"])
+        sh = GOOGLE.spreadsheet(CONFIG["gsheets_queries_spreadsheet_id"])
         ws = sh.sheet1  # первый лист
-        values = ws.col_values(2)  # колонка B
-        return [v.strip() for v in values[1:] if v and v.strip()]  # пропускаем B1
+        values = ws.get("B2:C")  # колонка B (+ частота в C), пропускаем B1
+        return [
+            (r[0].strip(), (r[1] if len(r) > 1 else "").strip())
+            for r in values if r and r[0] and r[0].strip()
+        ]
+
+def read_queries():
+    return [q for q, _ in read_query_rows()]
+
+QUERY_TOKEN_RE = re.compile(r"[\w+#&]+")
+
+def normalize_query(query):
+    """Ключ запроса: регистр, ё/е, пробелы, пунктуация и порядок слов не важны."""
+    if not CONFIG.get("query_dedup", True):
+        return query
+    words = QUERY_TOKEN_RE.findall(query.lower().replace("ё", "е"))
+    return " ".join(sorted(words)) or query.strip().lower()
+
+def retarget_calls(calls, query):
+    """Строки результата другого написания запроса — с этим запросом в колонке B."""
+    return [([row[:1] + [query] + row[2:] for row in rows], dict(kwargs)) for rows, kwargs in calls]
 
 def write_run_timestamp():
-    gc = gsheet_client()
-    sh = gc.open_by_key(CONFIG["gsheets_queries_spreadsheet_id"])
+    sh = GOOGLE.spreadsheet(CONFIG["gsheets_queries_spreadsheet_id"])
     ws = sh.sheet1
     ts = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
     ws.update_acell('A2', ts)
 
+# Фоновая загрузка скриншотов на Drive
+class DriveLink:
+    """Ячейка Results со ссылкой на скриншот, которая появится после фоновой загрузки."""
+    __slots__ = ("path",)
+
+    def __init__(self, path):
+        self.path = path
+
+
+class DriveUploader:
+    """
+    Грузит скриншоты на Drive в фоне, чтобы запрос не ждал загрузки.
+    У каждого воркера свой закэшированный Drive-клиент (httplib2 не потокобезопасен).
+    Очередь лежит на диске: незагруженное после рестарта догружается.
+    """
+
+    def __init__(self):
+        self.state_path = CONFIG.get("drive_queue_path", "/app/data/drive_queue.json")
+        self.workers = max(1, CONFIG.get("drive_upload_workers", 2))
+        self.retries = max(1, CONFIG.get("drive_upload_retries", 3))
+        self._cond = threading.Condition()
+        self._queue = queue.Queue()
+        self._pending = {}           # local_path -> filename
+        self._done = {}              # local_path -> {"link": str | None, "at": unix-time}
+        self._threads = []
+        self._stop = threading.Event()
+        self._local = threading.local()
+        self._load()
+
+    def start(self):
+        with self._cond:
+            for path in self._pending:
+                self._queue.put(path)
+            if self._pending:
+                log(f"[DRIVE] Догружаю {len(self._pending)} скриншотов с прошлого запуска")
+        for n in range(self.workers):
+            t = threading.Thread(target=self._worker, name=f"drive-upload-{n + 1}", daemon=True)
+            t.start()
+            self._threads.append(t)
+
+    def submit(self, local_path, filename=None):
+        with self._cond:
+            self._pending[local_path] = filename or os.path.basename(local_path)
+            self._save()
+        self._queue.put(local_path)
+        return DriveLink(local_path)
+
+    def is_pending(self, local_path):
+        with self._cond:
+            return local_path in self._pending
+
+    def pending_paths(self):
+        with self._cond:
+            return {os.path.abspath(p) for p in self._pending}
+
+    def link_for(self, local_path):
+        with self._cond:
+            return (self._done.get(local_path) or {}).get("link")
+
+    def wait(self, local_path, timeout):
+        with self._cond:
+            return self._cond.wait_for(lambda: local_path not in self._pending, timeout)
+
+    def close(self, timeout=None):
+        """
+        Дожидается очереди (не дольше timeout) и останавливает воркеров.
+        Воркеры доделывают текущую загрузку и выходят; остаток очереди остаётся
+        в drive_queue.json, так что следующий DriveUploader не загрузит файл повторно.
+        """
+        timeout = CONFIG.get("drive_final_wait_sec", 300) if timeout is None else timeout
+        with self._cond:
+            self._cond.wait_for(lambda: not self._pending, timeout)
+        self._stop.set()
+        for _ in self._threads:
+            self._queue.put(None)
+        for t in self._threads:
+            t.join()
+        self._threads = []
+        with self._cond:
+            left = len(self._pending)
+            self._save()
+        if left:
+            log(f"[DRIVE] В очереди осталось {left} скриншотов — догружу при следующем запуске")
+
+    def _worker(self):
+        while True:
+            path = self._queue.get()
+            if path is None or self._stop.is_set():
+                return
+            with self._cond:
+                filename = self._pending.get(path)
+            if filename is None:
+                continue
+
+            link = None
+            if os.path.exists(path):
+                for attempt in range(1, self.retries + 1):
+                    _, link = upload_to_drive(path, filename, drive=self._service())
+                    if link:
+                        break
+                    time.sleep(5 * attempt)
+            else:
+                log(f"[DRIVE] Файл пропал: {path}")
+
+            with self._cond:
+                self._pending.pop(path, None)
+                self._done[path] = {"link": link, "at": time.time()}
+                self._save()
+                self._cond.notify_all()
+
+    def _service(self):
+        if getattr(self._local, "drive", None) is None:
+            self._local.drive = build("drive", "v3", credentials=get_user_drive_creds(), cache_discovery=False)
+        return self._local.drive
+
+    def _load(self):
+        if not os.path.exists(self.state_path):
+            return
+        try:
+            with open(self.state_path, "r", encoding="utf-8") as f:
+                state = json.load(f)
+            self._pending = dict(state.get("pending", {}))
+            self._done = dict(state.get("done", {}))
+            self._prune_done()
+        except Exception as e:
+            log(f"[DRIVE] Не удалось прочитать очередь: {e}")
+
+    def _prune_done(self):
+        # Ссылки нужны только до записи строк в Results — неделю храним с запасом
+        week_ago = time.time() - 7 * 24 * 3600
+        self._done = {k: v for k, v in self._done.items() if v.get("at", 0) >= week_ago}
+
+    def _save(self):
+        # Загрузчик живёт весь процесс — чистим на каждом сохранении, а не только при старте
+        self._prune_done()
+        try:
+            os.makedirs(os.path.dirname(self.state_path), exist_ok=True)
+            tmp = self.state_path + ".tmp"
+            with open(tmp, "w", encoding="utf-8") as f:
+                json.dump({"pending": self._pending, "done": self._done}, f, ensure_ascii=False)
+            os.replace(tmp, self.state_path)
+        except Exception as e:
+            log(f"[DRIVE] Не удалось сохранить очередь: {e}")
+
+# Буферизованная запись результатов
+class TokenBucket:
+    """Не даёт превысить rate запросов в минуту (с допуском коротких всплесков)."""
+
+    def __init__(self, per_minute, capacity=None):
+        self.rate = max(1, per_minute) / 60.0
+        self.capacity = capacity or max(1, per_minute // 10)
+        self.tokens = float(self.capacity)
+        self.updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+
+def is_retryable_sheets_error(e):
+    if isinstance(e, gspread.exceptions.APIError):
+        code = getattr(getattr(e, "response", None), "status_code", None)
+        return code == 429 or (code is not None and code >= 500)
+    return isinstance(e, (requests.exceptions.ConnectionError, requests.exceptions.Timeout))
+
+
+def _encode_spool_row(row):
+    return [{"drive_link": c.path} if isinstance(c, DriveLink) else c for c in row]
+
+
+def _decode_spool_row(row):
+    return [DriveLink(c["drive_link"]) if isinstance(c, dict) and "drive_link" in c else c for c in row]
+
+
+class SheetsResultSink:
+    """
+    Копит строки результатов и пишет их в лист пачками, чтобы вызов Sheets API
+    не сидел на пути каждого запроса. Буфер дублируется в спул-файл на диске:
+    если квота/сеть подвели или контейнер упал, строки допишутся при следующем сбросе
+    (в том числе в следующем запуске). Повторяет 429/5xx с экспоненциальным бэкоффом;
+    пачку, которую Sheets отверг окончательно (400/403), уносит в dead-letter файл.
+    """
+
+    def __init__(self, ws, uploader=None):
+        self.ws = ws
+        self.uploader = uploader
+        self.flush_rows = CONFIG.get("results_flush_rows", 50)
+        self.flush_interval = CONFIG.get("results_flush_interval_sec", 60)
+        self.max_retries = CONFIG.get("sheets_max_retries", 5)
+        self.spool_path = CONFIG.get("results_spool_path", "/app/data/results_spool.jsonl")
+        self.deadletter_path = CONFIG.get("results_deadletter_path", "/app/data/results_deadletter.jsonl")
+        self.max_backoff = CONFIG.get("results_max_backoff_sec", 600)
+        self.bucket = TokenBucket(CONFIG.get("sheets_writes_per_minute", 50))
+
+        self._buffer = []            # [(value_input_option, row)]
+        self._oldest = None          # monotonic-время самой старой строки в буфере
+        self._retry_at = 0.0         # до этого момента фоновый сброс не пытаемся повторить
+        self._backoff = 0
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+
+        leftovers = self._read_spool()
+        if leftovers:
+            log(f"[RESULTS] Из спула прошлого запуска: {len(leftovers)} строк")
+            self._buffer.extend(leftovers)
+            self._oldest = time.monotonic()
+
+    # совместимость с gspread.Worksheet.append_rows/append_row
+    def append_rows(self, values, value_input_option="RAW"):
+        entries = [(value_input_option, list(row)) for row in values]
+        if not entries:
+            return
+        with self._lock:
+            self._buffer.extend(entries)
+            if self._oldest is None:
+                self._oldest = time.monotonic()
+            self._append_spool(entries)
+
+    def append_row(self, values, value_input_option="RAW"):
+        self.append_rows([values], value_input_option=value_input_option)
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name="results-sink", daemon=True)
+        self._thread.start()
+
+    def close(self):
+        """Останавливает фоновый сброс и пишет всё, что осталось."""
+        self._stop.set()
+        if self._thread:
+            self._thread.join()
+        self.flush(final=True)
+        with self._lock:
+            left = len(self._buffer)
+        if left:
+            log(f"[RESULTS] Не записано {left} строк — останутся в {self.spool_path}")
+
+    def flush(self, final=False):
+        """
+        Пишет буфер пачками (по одному value_input_option на вызов API).
+        Строки, чей скриншот ещё грузится, ждут следующего сброса;
+        при финальном сбросе ждём загрузку, но в сумме не дольше drive_final_wait_sec.
+        """
+        deadline = time.monotonic() + CONFIG.get("drive_final_wait_sec", 300) if final else None
+        with self._flush_lock:
+            while True:
+                with self._lock:
+                    if not self._buffer:
+                        self._oldest = None
+                        return True
+                    option = self._buffer[0][0]
+                    batch = []
+                    for opt, row in self._buffer:
+                        if opt != option:
+                            break
+                        if not final and self._has_pending_link(row):
+                            break
+                        batch.append(row)
+                if not batch:
+                    return True
+
+                rows = [self._resolve_links(row, deadline=deadline) for row in batch]
+                status, error = self._write(rows, option)
+                if status == "retry":
+                    self._backoff = min(max(self._backoff * 2, self.flush_interval), self.max_backoff)
+                    self._retry_at = time.monotonic() + self._backoff
+                    log(f"[RESULTS] Следующая попытка сброса через {self._backoff} сек")
+                    return False
+                if status == "fatal":
+                    self._dead_letter(rows, option, error)
+
+                with self._lock:
+                    del self._buffer[:len(batch)]
+                    self._oldest = time.monotonic() if self._buffer else None
+                    self._rewrite_spool()
+                if status == "ok":
+                    self._backoff = 0
+                    self._retry_at = 0.0
+                    log(f"[RESULTS] Записано {len(batch)} строк")
+
+    def _run(self):
+        while not self._stop.wait(1):
+            with self._lock:
+                due = bool(self._buffer) and (
+                    len(self._buffer) >= self.flush_rows
+                    or time.monotonic() - self._oldest >= self.flush_interval
+                )
+            if due and time.monotonic() >= self._retry_at:
+                self.flush()
+
+    def _has_pending_link(self, row):
+        return bool(self.uploader) and any(
+            isinstance(cell, DriveLink) and self.uploader.is_pending(cell.path) for cell in row
+        )
+
+    def _resolve_links(self, row, deadline=None):
+        out = []
+        for cell in row:
+            if isinstance(cell, DriveLink):
+                link = None
+                if self.uploader:
+                    if deadline is not None:
+                        self.uploader.wait(cell.path, max(0, deadline - time.monotonic()))
+                    link = self.uploader.link_for(cell.path)
+                cell = link or ""
+            out.append(cell)
+        return out
+
+    def _write(self, rows, option):
+        """Возвращает (статус, ошибка): "ok", "retry" — временный сбой, "fatal" — Sheets отверг пачку."""
+        delay = 2
+        for attempt in range(1, self.max_retries + 1):
+            self.bucket.acquire()
+            try:
+                with STAGE_SECONDS.labels("sheets_append").time():
+                    self.ws.append_rows(rows, value_input_option=option)
+                return "ok", None
+            except Exception as e:
+                if not is_retryable_sheets_error(e):
+                    log(f"[RESULTS] Sheets отверг {len(rows)} строк: {e}")
+                    return "fatal", e
+                if attempt == self.max_retries:
+                    log(f"[RESULTS] Ошибка записи {len(rows)} строк: {e}")
+                    return "retry", e
+                sleep_for = delay + random.uniform(0, delay / 2)
+                log(f"[RESULTS] Sheets недоступен ({e}), повтор через {sleep_for:.0f} сек")
+                time.sleep(sleep_for)
+                delay = min(delay * 2, 64)
+        return "retry", None
+
+    def _dead_letter(self, rows, option, error):
+        """Откладывает отвергнутую пачку в отдельный файл, чтобы она не блокировала буфер и спул."""
+        try:
+            os.makedirs(os.path.dirname(self.deadletter_path), exist_ok=True)
+            with open(self.deadletter_path, "a", encoding="utf-8") as f:
+                for row in rows:
+                    f.write(json.dumps({"opt": option, "row": row, "error": str(error)}, ensure_ascii=False) + "\n")
+            log(f"[RESULTS] {len(rows)} строк отложено в {self.deadletter_path}")
+        except Exception as e:
+            log(f"[RESULTS] Ошибка записи dead-letter, пачка потеряна ({len(rows)} строк): {e}")
+
+    def _read_spool(self):
+        if not os.path.exists(self.spool_path):
+            return []
+        entries = []
+        try:
+            with open(self.spool_path, "r", encoding="utf-8") as f:
+                for line in f:
+                    line = line.strip()
+                    if line:
+                        item = json.loads(line)
+                        entries.append((item["opt"], _decode_spool_row(item["row"])))
+        except Exception as e:
+            log(f"[RESULTS] Спул повреждён, читаю что смог: {e}")
+        return entries
+
+    def _append_spool(self, entries):
+        try:
+            os.makedirs(os.path.dirname(self.spool_path), exist_ok=True)
+            with open(self.spool_path, "a", encoding="utf-8") as f:
+                for opt, row in entries:
+                    f.write(json.dumps({"opt": opt, "row": _encode_spool_row(row)}, ensure_ascii=False) + "\n")
+                f.flush()
+                os.fsync(f.fileno())
+        except Exception as e:
+            log(f"[RESULTS] Ошибка записи спула: {e}")
+
+    def _rewrite_spool(self):
+        try:
+            if not self._buffer:
+                if os.path.exists(self.spool_path):
+                    os.remove(self.spool_path)
+                return
+            tmp = self.spool_path + ".tmp"
+            with open(tmp, "w", encoding="utf-8") as f:
+                for opt, row in self._buffer:
+                    f.write(json.dumps({"opt": opt, "row": _encode_spool_row(row)}, ensure_ascii=False) + "\n")
+            os.replace(tmp, self.spool_path)
+        except Exception as e:
+            log(f"[RESULTS] Ошибка обновления спула: {e}")
+
 # Selenium helpers
 def resolve_final_url_via_selenium(driver, href, timeout=10):
     """
@@ -342,7 +1183,8 @@ def resolve_final_url_via_selenium(driver, href, timeout=10):
 
     return final_url
 
-def create_driver(user_agent=None):
+@STAGE_SECONDS.labels("driver_startup").time()
+def create_driver(user_agent=None, cookies_path=None):
     opts = Options()
 
     if CONFIG.get("headless", False):
@@ -360,7 +1202,7 @@ def create_driver(user_agent=None):
     driver = webdriver.Chrome(options=opts)
     driver.set_page_load_timeout(CONFIG.get("page_load_timeout_sec", 25))
 
-    load_cookies(driver)
+    load_cookies(driver, cookies_path)
 
     if not CONFIG.get("headless", False):
         try:
@@ -377,6 +1219,114 @@ def safe_quit_driver(driver):
         pass
     # НИЧЕГО не удаляем — куки живут
 
+class DriverPool:
+    """
+    Держит «прогретые» браузеры между запросами, чтобы не платить
+    за холодный старт Chrome и повторную загрузку cookies на каждой попытке.
+    Между использованиями состояние сбрасывается (лишние вкладки, размер окна, UA),
+    браузер пересоздаётся после max_uses запросов или после сбоя.
+    """
+
+    def __init__(self, size=1, max_uses=20, cookies_path=None, user_agent=None):
+        self.size = max(1, int(size))
+        self.max_uses = max(1, int(max_uses))
+        # Личность сессии: свой файл cookies и (опционально) фиксированный UA
+        self.cookies_path = cookies_path or CONFIG["cookies_path"]
+        self.user_agent = user_agent
+        # LIFO: сначала берём только что освобождённый прогретый браузер, а не пустой слот
+        self._idle = queue.LifoQueue()
+        self._uses = {}
+        self._lock = threading.Lock()
+        # Пустые слоты: браузер создаётся лениво при первом acquire
+        for _ in range(self.size):
+            self._idle.put(None)
+
+    def acquire(self, user_agent=None):
+        user_agent = self.user_agent or user_agent
+        driver = self._idle.get()
+        try:
+            if driver is not None and not self._is_alive(driver):
+                log("[POOL] Браузер не отвечает — пересоздаю")
+                self._discard(driver)
+                driver = None
+
+            if driver is None:
+                driver = create_driver(user_agent=user_agent, cookies_path=self.cookies_path)
+                with self._lock:
+                    self._uses[driver] = 0
+            else:
+                self._reset(driver, user_agent)
+        except Exception:
+            if driver is not None:
+                self._discard(driver)
+            self._idle.put(None)
+            raise
+
+        with self._lock:
+            self._uses[driver] += 1
+        return driver
+
+    def release(self, driver, broken=False):
+        if driver is None:
+            self._idle.put(None)
+            return
+        with self._lock:
+            uses = self._uses.get(driver, 0)
+        if broken or uses >= self.max_uses:
+            reason = "сбой" if broken else f"{uses} использований"
+            log(f"[POOL] Пересоздаю браузер ({reason})")
+            self._discard(driver)
+            self._idle.put(None)
+        else:
+            self._idle.put(driver)
+
+    def close(self):
+        while True:
+            try:
+                driver = self._idle.get_nowait()
+            except queue.Empty:
+                break
+            if driver is not None:
+                self._discard(driver)
+        with self._lock:
+            leftovers = list(self._uses)
+        for driver in leftovers:
+            self._discard(driver)
+
+    def _discard(self, driver):
+        with self._lock:
+            self._uses.pop(driver, None)
+        safe_quit_driver(driver)
+
+    @staticmethod
+    def _is_alive(driver):
+        try:
+            driver.current_window_handle
+            return True
+        except Exception:
+            return False
+
+    @staticmethod
+    def _reset(driver, user_agent=None):
+        """Закрывает лишние вкладки, возвращает окно в исходный размер и меняет UA."""
+        handles = driver.window_handles
+        for handle in handles[1:]:
+            driver.switch_to.window(handle)
+            driver.close()
+        driver.switch_to.window(handles[0])
+        driver.get("about:blank")
+
+        # fullpage_screenshot растягивает окно под всю страницу
+        driver.set_window_size(1920, 1080)
+        if not CONFIG.get("headless", False):
+            try:
+                driver.maximize_window()
+            except Exception:
+                pass
+
+        if user_agent:
+            driver.execute_cdp_cmd("Network.setUserAgentOverride", {"userAgent": user_agent})
+
 
 def fullpage_screenshot(driver, path_png):
     """
@@ -398,6 +1348,107 @@ def fullpage_screenshot(driver, path_png):
 
     driver.save_screenshot(path_png)
 
+# Высота области для скриншота: низ N-го видимого блока выдачи (или вся страница)
+SCREENSHOT_CLIP_JS = r"""
+const mode = arguments[0];
+const topResults = arguments[1];
+const doc = document.documentElement;
+const width = Math.max(document.body.scrollWidth, doc.scrollWidth, window.innerWidth);
+const fullHeight = Math.max(document.body.scrollHeight, doc.scrollHeight);
+let height = fullHeight;
+if (mode === "viewport") {
+    height = window.innerHeight;
+} else if (mode === "top") {
+    const items = Array.from(document.querySelectorAll('li[class*="serp-item"], div[class*="serp-item"]'))
+        .filter((el) => el.offsetWidth || el.offsetHeight);
+    const last = items[Math.min(topResults, items.length) - 1];
+    if (last) {
+        height = Math.min(fullHeight, last.getBoundingClientRect().bottom + window.scrollY + 16);
+    }
+}
+return {width: Math.min(width, 1920), height: Math.max(200, Math.ceil(height))};
+"""
+
+SCREENSHOT_MIMETYPES = {".png": "image/png", ".jpg": "image/jpeg", ".jpeg": "image/jpeg", ".webp": "image/webp"}
+
+
+def screenshot_mimetype(path):
+    return SCREENSHOT_MIMETYPES.get(os.path.splitext(path)[1].lower(), "application/octet-stream")
+
+
+@STAGE_SECONDS.labels("screenshot").time()
+def capture_screenshot(driver, path_base):
+    """
+    Скриншот через CDP Page.captureScreenshot: область (mode), формат, качество
+    и масштаб берутся из CONFIG. Окно не растягивается, поэтому нет лишнего reflow.
+    Возвращает путь к файлу (расширение зависит от формата).
+    При ошибке CDP откатывается на старый fullpage_screenshot в PNG.
+    """
+    fmt = CONFIG.get("screenshot_format", "webp").lower()
+    if fmt == "jpg":
+        fmt = "jpeg"
+    ext = {"jpeg": ".jpg", "webp": ".webp"}.get(fmt, ".png")
+
+    try:
+        clip = driver.execute_script(
+            SCREENSHOT_CLIP_JS,
+            CONFIG.get("screenshot_mode", "top"),
+            int(CONFIG.get("screenshot_top_results", CONFIG.get("top_n", 5))),
+        )
+        params = {
+            "format": fmt,
+            "captureBeyondViewport": True,
+            "clip": {"x": 0, "y": 0, "width": clip["width"], "height": clip["height"],
+                     "scale": float(CONFIG.get("screenshot_scale", 1.0))},
+        }
+        if fmt != "png":
+            params["quality"] = int(CONFIG.get("screenshot_quality", 70))
+        data = driver.execute_cdp_cmd("Page.captureScreenshot", params)["data"]
+        path = path_base + ext
+        with open(path, "wb") as f:
+            f.write(base64.b64decode(data))
+        return path
+    except Exception as e:
+        log(f"[SCREENSHOT] CDP недоступен ({e}), делаю PNG всей страницы")
+        path = path_base + ".png"
+        fullpage_screenshot(driver, path)
+        return path
+
+
+def prune_screenshots(screenshots_dir=None, uploader=None):
+    """
+    Удаляет локальные скриншоты старше screenshot_keep_days и сверх screenshot_max_files.
+    Файлы, которые ещё ждут загрузки на Drive (очередь uploader), не трогаем.
+    """
+    screenshots_dir = screenshots_dir or CONFIG.get("screenshot_dir", "/app/data/screenshots")
+    if not os.path.isdir(screenshots_dir):
+        return 0
+    keep_days = CONFIG.get("screenshot_keep_days", 14)
+    max_files = CONFIG.get("screenshot_max_files", 2000)
+
+    files = []
+    for name in os.listdir(screenshots_dir):
+        path = os.path.join(screenshots_dir, name)
+        if os.path.isfile(path) and os.path.splitext(name)[1].lower() in SCREENSHOT_MIMETYPES:
+            files.append((os.path.getmtime(path), path))
+    files.sort(reverse=True)  # новые первыми
+
+    cutoff = time.time() - keep_days * 24 * 3600 if keep_days else None
+    pending = uploader.pending_paths() if uploader else set()
+    removed = 0
+    for i, (mtime, path) in enumerate(files):
+        if (cutoff and mtime < cutoff) or (max_files and i >= max_files):
+            if os.path.abspath(path) in pending:
+                continue
+            try:
+                os.remove(path)
+                removed += 1
+            except OSError:
+                pass
+    if removed:
+        log(f"[SCREENSHOT] Удалено старых скриншотов: {removed}")
+    return removed
+
 def timestamp_str():
     return datetime.now().strftime("%Y-%m-%d_%H-%M-%S")
 
@@ -446,6 +1497,7 @@ def find_search_box(driver, wait_sec=6):
             continue
     return None
 
+@STAGE_SECONDS.labels("search_flow").time()
 def human_like_search_flow(driver, query):
     # Порядок: ya.ru → yandex.ru → фолбэк на search/?text=
     for start_url in ["https://ya.ru/", "https://yandex.ru/"]:
@@ -480,16 +1532,80 @@ def human_like_search_flow(driver, query):
     return "ok" if not is_yandex_captcha(driver) else "captcha"
 
 # CAPTCHA detect & manual wait
+# Проверка капчи выполняется в браузере и возвращает только bool: раньше на
+# каждый вызов через WebDriver гонялся весь page_source (сотни КБ).
+_CAPTCHA_PROBE_JS = r"""
+const isCaptcha = () => {
+    const href = location.href.toLowerCase();
+    if (href.includes("showcaptcha") || href.includes("checkcaptcha")) return true;
+    if (document.querySelector(
+        ".CheckboxCaptcha, .AdvancedCaptcha, .SmartCaptcha, form[action*='checkcaptcha'], "
+        + "iframe[src*='smartcaptcha'], script[src*='smartcaptcha']"
+    )) return true;
+    const text = (document.body ? document.body.textContent : "").toLowerCase();
+    return ["smartcaptcha", "я не робот", "подтвердите, что запросы отправляли вы"]
+        .some((p) => text.includes(p));
+};
+"""
+
+IS_CAPTCHA_JS = _CAPTCHA_PROBE_JS + "return isCaptcha();"
+
+# Ждёт исчезновения капчи: MutationObserver перепроверяет страницу на каждое
+# изменение DOM. Возвращает true (капча пропала), false (истекло окно ожидания)
+# или null (страница уходит — проверим уже новую).
+WAIT_CAPTCHA_GONE_JS = _CAPTCHA_PROBE_JS + r"""
+const waitMs = arguments[0];
+const done = arguments[arguments.length - 1];
+if (!isCaptcha()) { done(true); return; }
+let finished = false;
+let timer = null;
+const observer = new MutationObserver(() => { if (!isCaptcha()) finish(true); });
+const finish = (value) => {
+    if (finished) return;
+    finished = true;
+    observer.disconnect();
+    clearTimeout(timer);
+    done(value);
+};
+observer.observe(document.documentElement, {childList: true, subtree: true, attributes: true, characterData: true});
+window.addEventListener("pagehide", () => finish(null), {once: true});
+timer = setTimeout(() => finish(false), waitMs);
+"""
+
+
 def is_yandex_captcha(driver):
-    html = (driver.page_source or "").lower()
-    if ("smartcaptcha" in html or "я не робот" in html
-        or "подтвердите, что запросы отправляли вы" in html):
-        return True
+    """True/False; None — проверить не удалось (идёт навигация, контекст устарел, сессия упала)."""
     try:
-        driver.find_element(By.XPATH, "//*[contains(text(),'Я не робот') or contains(text(),'SmartCaptcha')]")
-        return True
+        return bool(driver.execute_script(IS_CAPTCHA_JS))
     except Exception:
-        return False
+        return None
+
+
+def watch_captcha_gone(driver, wait_sec):
+    """
+    Блокируется, пока капча не исчезнет или не пройдёт wait_sec.
+    True — капчи больше нет, False — всё ещё капча или состояние неизвестно (опросим снова).
+    """
+    previous = None
+    try:
+        previous = driver.timeouts.script
+        driver.set_script_timeout(wait_sec + 5)
+        result = driver.execute_async_script(WAIT_CAPTCHA_GONE_JS, int(wait_sec * 1000))
+    except Exception:
+        # Навигация во время ожидания обрывает скрипт — это нормально
+        result = None
+    finally:
+        # драйвер из пула — не оставляем ему чужой таймаут
+        if previous is not None:
+            try:
+                driver.set_script_timeout(previous)
+            except Exception:
+                pass
+    if result is None:
+        time.sleep(CONFIG.get("manual_captcha_poll_sec", 2))
+        # упавшая проверка — не повод считать капчу решённой
+        return is_yandex_captcha(driver) is False
+    return bool(result)
 
 def notify_user_captcha(query):
     """Уведомляет о капче."""
@@ -497,84 +1613,127 @@ def notify_user_captcha(query):
     log(f"[CAPTCHA] {msg}")
     send_telegram(msg)
 
-def wait_user_to_solve_captcha(driver, query):
+def wait_user_to_solve_captcha(driver, query, cookies_path=None):
     """Ждёт пока пользователь решит капчу."""
     notify_user_captcha(query)
     
     total = CONFIG.get("manual_captcha_total_wait_sec", 300)
-    poll = CONFIG.get("manual_captcha_poll_sec", 2)
+    watch = CONFIG.get("manual_captcha_watch_sec", 30)
     deadline = time.time() + total
-    
-    while time.time() < deadline:
+
+    while True:
+        remaining = deadline - time.time()
+        if remaining <= 0:
+            break
+
         try:
             driver.execute_script("window.scrollBy(0, 50);")
         except:
             pass
-        
-        if not is_yandex_captcha(driver):
+
+        if watch_captcha_gone(driver, min(watch, remaining)):
             # Капча решена — сохраняем cookies
-            save_cookies(driver)
+            save_cookies(driver, cookies_path)
             send_telegram(f"✅ Капча решена: {query}")
             log(f"[CAPTCHA] Решена для: {query}")
             return True
-        
-        time.sleep(poll)
-    
+
+    TIMEOUTS.labels("captcha").inc()
+    # В PACING эту капчу уже посчитал вызывающий код — второй раз не учитываем
     send_telegram(f"❌ Таймаут капчи: {query}")
     log(f"[CAPTCHA] Таймаут для: {query}")
     return False
 
 # Core: parse Yandex SERP
-def parse_ads_positions(driver):
-    """
-    Просматривает первые CONFIG["top_n"] позиций выдачи (например, 5).
-    Возвращает только те из них, где есть метка Промо/Реклама.
-    domain берётся из сниппета на главной странице (без переходов).
-    """
-    limit = int(CONFIG.get("top_n", 5))
+# Один проход execute_script собирает все блоки выдачи в JSON. Раньше каждый
+# find_elements / .text / get_attribute / is_displayed был отдельным запросом
+# к chromedriver, теперь вся логика ниже работает по одному снимку DOM.
+SERP_SNAPSHOT_JS = r"""
+const labels = arguments[0] || [];
+const maxBlocks = arguments[1] || 50;
+const norm = (s) => (s || "").replace(/\s+/g, " ").trim();
+const visible = (el) => {
+    if (!(el.offsetWidth || el.offsetHeight || el.getClientRects().length)) return false;
+    return getComputedStyle(el).visibility !== "hidden";
+};
+const text = (el) => (visible(el) ? (el.innerText || "") : "").trim();
+
+const blocks = document.querySelectorAll('li[class*="serp-item"], div[class*="serp-item"]');
+const out = [];
+for (const block of blocks) {
+    if (out.length >= maxBlocks) break;
+
+    const links = [];
+    for (const a of block.querySelectorAll("a[href]")) {
+        links.push({
+            href: a.href || a.getAttribute("href") || "",
+            text: text(a),
+            has_heading: !!a.querySelector("h2, h3"),
+            role: a.getAttribute("role") || "",
+        });
+    }
+
+    const labelTexts = [];
+    if (labels.length) {
+        for (const n of block.querySelectorAll("span, div, b, small")) {
+            const t = norm(n.textContent);
+            if (labels.some((l) => t.includes(l))) labelTexts.push(text(n));
+        }
+    }
+
+    const heading = block.querySelector("h2, h3");
+    const blockText = text(block);
+    out.push({
+        visible: visible(block),
+        links: links,
+        heading: heading ? text(heading) : "",
+        label_texts: labelTexts,
+        path_texts: Array.from(block.querySelectorAll('[class*="Path"], [class*="path"]')).map(text),
+        text: blockText.split("\n").slice(0, 6).join("\n"),
+    });
+}
+return out;
+"""
 
-    def has_ad_marker(block) -> bool:
-        try:
-            for lbl in CONFIG.get("ad_labels", ["Реклама", "Промо"]):
-                nodes = block.find_elements(
-                    By.XPATH,
-                    f".//*[(self::span or self::div or self::b or self::small) "
-                    f"and contains(normalize-space(.), '{lbl}')]"
-                )
-                for n in nodes:
-                    t = (n.text or "").strip()
-                    if 0 < len(t) <= 20:
-                        return True
-        except Exception:
-            pass
-        return False
 
-    def extract_best_link(block):
-        xps = [
-            ".//a[@href][.//h2 or .//h3]",
-            ".//a[@href][@role='link']",
-            ".//a[@href]",
-        ]
-        for xp in xps:
-            try:
-                links = block.find_elements(By.XPATH, xp)
-                for a in links:
-                    href = a.get_attribute("href")
-                    if not href:
-                        continue
-                    if href.startswith("javascript"):
-                        continue
-                    if len((a.text or "").strip()) == 0:
-                        continue
-                    return a
-            except Exception:
+def snapshot_serp_blocks(driver, max_blocks=50):
+    """Снимок блоков выдачи одним вызовом execute_script."""
+    labels = CONFIG.get("ad_labels", ["Реклама", "Промо"])
+    return driver.execute_script(SERP_SNAPSHOT_JS, labels, max_blocks) or []
+
+
+def has_ad_marker(block):
+    """Есть ли в блоке короткая метка Реклама/Промо (длинный текст — это сниппет, не метка)."""
+    return any(0 < len((t or "").strip()) <= 20 for t in block.get("label_texts") or [])
+
+
+def extract_best_link(block):
+    """Ссылка с заголовком → ссылка с role=link → любая ссылка с текстом."""
+    checks = [
+        lambda a: a.get("has_heading"),
+        lambda a: a.get("role") == "link",
+        lambda a: True,
+    ]
+    links = block.get("links") or []
+    for check in checks:
+        for a in links:
+            href = a.get("href")
+            if not href or href.startswith("javascript"):
                 continue
-        return None
+            if not (a.get("text") or "").strip():
+                continue
+            if check(a):
+                return a
+    return None
 
-    blocks = driver.find_elements(
-        By.XPATH,
-        "//li[contains(@class,'serp-item')] | //div[contains(@class,'serp-item')]"
-    )
+
+def ads_from_blocks(blocks, limit=None):
+    """
+    Просматривает первые limit позиций выдачи по снимку блоков.
+    Возвращает только те из них, где есть метка Промо/Реклама.
+    """
+    if limit is None:
+        limit = int(CONFIG.get("top_n", 5))
 
     out = []
     pos = 0  # позиция в выдаче (1..limit)
@@ -583,20 +1742,13 @@ def parse_ads_positions(driver):
         if pos >= limit:
             break
 
-        try:
-            if not block.is_displayed():
-                continue
-        except Exception:
-            pass
+        if not block.get("visible", True):
+            continue
 
         link = extract_best_link(block)
         if not link:
             continue
 
-        href = link.get_attribute("href")
-        if not href:
-            continue
-
         # засчитываем позицию результата
         pos += 1
 
@@ -604,53 +1756,392 @@ def parse_ads_positions(driver):
         if not has_ad_marker(block):
             continue
 
-        title = text_or_empty(link)
-        if not title:
-            try:
-                title = text_or_empty(block.find_element(By.XPATH, ".//h2 | .//h3"))
-            except Exception:
-                title = ""
-
+        title = (link.get("text") or "").strip() or (block.get("heading") or "").strip()
         dom = extract_display_domain(block) or "UNRESOLVED"
 
         out.append({
             "position": pos,      # позиция среди ТОП-5 выдачи
             "label": "AD",
             "title": title,
-            "url": href,          # можно оставить yabs-ссылку, это уже не влияет на domain
+            "url": link["href"],  # можно оставить yabs-ссылку, это уже не влияет на domain
             "domain": dom,        # mts.ru и т.п. с главной страницы
         })
 
     return out
 
+
+@STAGE_SECONDS.labels("parse").time()
+def parse_ads_positions(driver):
+    """
+    Просматривает первые CONFIG["top_n"] позиций выдачи (например, 5).
+    Возвращает только те из них, где есть метка Промо/Реклама.
+    domain берётся из сниппета на главной странице (без переходов).
+    """
+    return ads_from_blocks(snapshot_serp_blocks(driver))
+
+# Offline: parse saved SERP HTML
+# Те же снимки блоков, что и snapshot_serp_blocks, но из сырого page_source —
+# без браузера. XPath-выражения компилируются один раз при импорте.
+_XP_JUNK = etree.XPath("//script | //style | //noscript")
+_XP_BLOCKS = etree.XPath("//li[contains(@class,'serp-item')] | //div[contains(@class,'serp-item')]")
+_XP_LINKS = etree.XPath(".//a[@href]")
+_XP_HAS_HEADING = etree.XPath("boolean(.//h2 | .//h3)")
+_XP_HEADING = etree.XPath("(.//h2 | .//h3)[1]")
+_XP_LABEL_NODES = etree.XPath(
+    ".//*[(self::span or self::div or self::b or self::small) and contains(normalize-space(.), $label)]"
+)
+_XP_PATHS = etree.XPath(".//*[contains(@class,'Path') or contains(@class,'path')]")
+_XP_HIDDEN = etree.XPath(
+    "boolean(ancestor-or-self::*[@hidden or @aria-hidden='true'"
+    " or contains(translate(@style, ' ', ''), 'display:none')"
+    " or contains(translate(@style, ' ', ''), 'visibility:hidden')])"
+)
+_WS_RE = re.compile(r"\s+")
+
+
+def _html_text(el):
+    if _XP_HIDDEN(el):
+        return ""
+    return _WS_RE.sub(" ", "".join(el.itertext())).strip()
+
+
+def _html_lines(el, limit=6):
+    lines = []
+    for chunk in el.itertext():
+        chunk = _WS_RE.sub(" ", chunk).strip()
+        if chunk:
+            lines.append(chunk)
+            if len(lines) >= limit:
+                break
+    return "\n".join(lines)
+
+
+def snapshot_serp_html(page_html, base_url="https://yandex.ru/search/", max_blocks=50):
+    """Снимок блоков выдачи из сохранённого HTML (формат как у snapshot_serp_blocks)."""
+    doc = lxml_html.fromstring(page_html)
+    for junk in _XP_JUNK(doc):
+        junk.drop_tree()
+
+    labels = CONFIG.get("ad_labels", ["Реклама", "Промо"])
+    out = []
+    for block in _XP_BLOCKS(doc)[:max_blocks]:
+        links = [
+            {
+                "href": urljoin(base_url, a.get("href") or ""),
+                "text": _html_text(a),
+                "has_heading": _XP_HAS_HEADING(a),
+                "role": a.get("role") or "",
+            }
+            for a in _XP_LINKS(block)
+        ]
+        label_texts = [_html_text(n) for lbl in labels for n in _XP_LABEL_NODES(block, label=lbl)]
+        heading = _XP_HEADING(block)
+        out.append({
+            "visible": not _XP_HIDDEN(block),
+            "links": links,
+            "heading": _html_text(heading[0]) if heading else "",
+            "label_texts": label_texts,
+            "path_texts": [_html_text(p) for p in _XP_PATHS(block)],
+            "text": "" if _XP_HIDDEN(block) else _html_lines(block),
+        })
+    return out
+
+
+def parse_ads_from_html(page_html, base_url="https://yandex.ru/search/"):
+    """Тот же результат, что parse_ads_positions, но по сырому page_source."""
+    return ads_from_blocks(snapshot_serp_html(page_html, base_url=base_url))
+
+
+def save_serp_html(driver, name, page_html=None):
+    """Сохраняет page_source выдачи (или уже скачанный page_html), чтобы её можно было перепарсить офлайн."""
+    try:
+        if page_html is None:
+            page_html = driver.page_source
+        html_dir = CONFIG.get("serp_html_dir", "/app/data/serp_html")
+        os.makedirs(html_dir, exist_ok=True)
+        path = os.path.join(html_dir, f"{name}.html")
+        with open(path, "w", encoding="utf-8") as f:
+            f.write(page_html or "")
+        return path
+    except Exception as e:
+        log(f"[HTML] Ошибка сохранения: {e}")
+        return None
+
+# Adaptive pacing
+class PacingController:
+    """
+    AIMD-регулятор паузы между запросами по наблюдаемой частоте капч.
+    Каждые pacing_calm_streak запросов без капчи пауза уменьшается на
+    pacing_decrease_step_sec, каждая капча умножает её на pacing_captcha_factor.
+    Бэкофф после капчи масштабируется так же. Один регулятор на все сессии:
+    капчу Яндекс выдаёт на IP, а не на браузер.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._loaded = False
+        self.pause = None
+        self.calm = 0
+
+    @property
+    def enabled(self):
+        return CONFIG.get("adaptive_pacing", True)
+
+    @property
+    def baseline(self):
+        low, high = CONFIG.get("per_query_pause_sec", (35, 70))
+        return (low + high) / 2
+
+    def next_pause(self):
+        """Пауза перед следующим запросом с «человеческим» разбросом ±20%."""
+        if not self.enabled:
+            return random.uniform(*CONFIG.get("per_query_pause_sec", (30, 60)))
+        with self._lock:
+            self._load()
+            pause = self.pause
+        return random.uniform(pause * 0.8, pause * 1.2)
+
+    def captcha_backoff(self, attempt):
+        backoffs = CONFIG.get("captcha_backoff_sec", [120, 300])
+        base = backoffs[min(attempt - 1, len(backoffs) - 1)]
+        if not self.enabled:
+            return base
+        with self._lock:
+            self._load()
+            scale = self.pause / self.baseline
+        return base * min(4.0, max(0.5, scale))
+
+    def on_success(self):
+        if not self.enabled:
+            return
+        with self._lock:
+            self._load()
+            self.calm += 1
+            if self.calm >= CONFIG.get("pacing_calm_streak", 3):
+                self.calm = 0
+                self.pause = max(CONFIG.get("pacing_min_pause_sec", 15),
+                                 self.pause - CONFIG.get("pacing_decrease_step_sec", 3))
+            self._save()
+
+    def on_captcha(self):
+        if not self.enabled:
+            return
+        with self._lock:
+            self._load()
+            self.calm = 0
+            self.pause = min(CONFIG.get("pacing_max_pause_sec", 240),
+                             self.pause * CONFIG.get("pacing_captcha_factor", 2.0))
+            log(f"[PACING] Капча — пауза увеличена до {self.pause:.0f} сек")
+            self._save()
+
+    def _load(self):
+        if self._loaded:
+            return
+        self._loaded = True
+        self.pause = self.baseline
+        path = CONFIG.get("pacing_state_path", "/app/data/pacing_state.json")
+        try:
+            if os.path.exists(path):
+                with open(path, "r", encoding="utf-8") as f:
+                    state = json.load(f)
+                self.pause = float(state.get("pause", self.pause))
+                self.calm = int(state.get("calm", 0))
+                log(f"[PACING] Базовая пауза из прошлых запусков: {self.pause:.0f} сек")
+        except Exception as e:
+            log(f"[PACING] Не удалось прочитать состояние: {e}")
+        PACING_PAUSE.set(self.pause)
+
+    def _save(self):
+        PACING_PAUSE.set(self.pause)
+        path = CONFIG.get("pacing_state_path", "/app/data/pacing_state.json")
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            tmp = path + ".tmp"
+            with open(tmp, "w", encoding="utf-8") as f:
+                json.dump({"pause": self.pause, "calm": self.calm, "updated": time.time()}, f)
+            os.replace(tmp, path)
+        except Exception as e:
+            log(f"[PACING] Не удалось сохранить состояние: {e}")
+
+
+PACING = PacingController()
+
+# HTTP-first fetch
+_http_local = threading.local()
+
+
+def http_session(cookies_path, user_agent=None):
+    """
+    requests.Session на поток и файл cookies: соединения к yandex.ru переиспользуются
+    (keep-alive), cookies перечитываются только если файл изменился.
+    """
+    sessions = getattr(_http_local, "sessions", None)
+    if sessions is None:
+        sessions = _http_local.sessions = {}
+    entry = sessions.get(cookies_path)
+    if entry is None:
+        sess = requests.Session()
+        sess.headers.update({
+            "Accept": "text/html,application/xhtml+xml,application/xml;q=0.9,*/*;q=0.8",
+            "Accept-Language": "ru-RU,ru;q=0.9,en;q=0.8",
+        })
+        entry = sessions[cookies_path] = {"session": sess, "mtime": None}
+
+    sess = entry["session"]
+    if user_agent:
+        sess.headers["User-Agent"] = user_agent
+
+    try:
+        mtime = os.path.getmtime(cookies_path)
+    except OSError:
+        mtime = None
+    if mtime != entry["mtime"]:
+        entry["mtime"] = mtime
+        sess.cookies.clear()
+        if mtime is not None:
+            try:
+                with open(cookies_path, "r") as f:
+                    for c in json.load(f):
+                        sess.cookies.set_cookie(requests.cookies.create_cookie(
+                            name=c["name"], value=c["value"],
+                            domain=c.get("domain", ".yandex.ru"), path=c.get("path", "/"),
+                            secure=c.get("secure", False),
+                        ))
+            except Exception as e:
+                log(f"[HTTP] Не удалось загрузить cookies: {e}")
+    return sess
+
+
+@STAGE_SECONDS.labels("http_fetch").time()
+def fetch_serp_http(query, cookies_path, user_agent=None):
+    """
+    GET https://yandex.ru/search/?text=... без браузера.
+    Возвращает (status, html, url), status: "ok" | "captcha" | "error".
+    """
+    url = f"https://yandex.ru/search/?text={urllib.parse.quote_plus(query)}"
+    try:
+        r = http_session(cookies_path, user_agent).get(url, timeout=CONFIG.get("http_timeout_sec", 15))
+    except requests.RequestException as e:
+        log(f"[HTTP] Ошибка запроса: {e}")
+        return "error", None, url
+
+    html = r.text or ""
+    low_url = r.url.lower()
+    if ("showcaptcha" in low_url or "checkcaptcha" in low_url or r.status_code in (403, 429)
+            or "smartcaptcha" in html.lower()):
+        return "captcha", html, r.url
+    if r.status_code != 200:
+        log(f"[HTTP] Код ответа {r.status_code}")
+        return "error", html, r.url
+    return "ok", html, r.url
+
+
+def run_for_query_http(query, ws_results, pool):
+    """
+    Лёгкий путь без браузера. Возвращает результат как run_for_query,
+    None или "captcha" (уже учтена в PACING), если нужно откатиться на Selenium.
+    """
+    ua = pool.user_agent or random.choice(CONFIG.get("rotate_user_agents", []) or [None])
+    status, page_html, url = fetch_serp_http(query, pool.cookies_path, ua)
+    if status == "captcha":
+        # капча/403/429 по HTTP — тот же сигнал для регулятора паузы, что и в браузере
+        CAPTCHAS.inc()
+        PACING.on_captcha()
+        log("[HTTP] Капча — переключаюсь на браузер")
+        return "captcha"
+    if status != "ok":
+        return None
+
+    try:
+        blocks = snapshot_serp_html(page_html, base_url=url)
+    except Exception as e:
+        log(f"[HTTP] Не удалось разобрать HTML: {e}")
+        return None
+    if not blocks:
+        log("[HTTP] На странице нет блоков выдачи — переключаюсь на браузер")
+        return None
+
+    ads = ads_from_blocks(blocks)
+    log(f"[HTTP] Найдено {len(ads)} рекламных позиций")
+    ADS_FOUND.inc(len(ads))
+
+    ts = timestamp_str()
+    if CONFIG.get("save_serp_html", False):
+        safe_name = re.sub(r'[^А-Яа-яA-Za-z0-9_\- ]+', '_', query)[:50]
+        save_serp_html(None, f"{safe_name}_{ts}", page_html=page_html)
+
+    if not ads:
+        ws_results.append_row([ts, query, "", "SUCCESS_NO_ADS", "", url, "yandex.ru", ""])
+        log("[QUERY] Реклама не найдена")
+    else:
+        rows = [
+            [ts, query, it["position"], "SUCCESS", it["title"], it["url"], it["domain"], ""]
+            for it in ads
+        ]
+        ws_results.append_rows(rows, value_input_option="USER_ENTERED")
+        log(f"[QUERY] Записано {len(rows)} строк")
+
+    PACING.on_success()
+    pause = PACING.next_pause()
+    log(f"[QUERY] Пауза {pause:.0f} сек")
+    time.sleep(pause)
+    return {"ok": True, "attempts": 1}
+
 # Main per-query with manual-captcha + retries
-def run_for_query(query, ws_results):
+def run_for_query(query, ws_results, pool, uploader=None):
     log(f"[QUERY] Начинаю: {query}")
 
+    # Одна капча — одно событие для PACING: капчу, которую уже увидел HTTP-путь,
+    # первая попытка браузера (скорее всего, та же блокировка) не учитывает повторно
+    captcha_counted = False
+    if CONFIG.get("http_first", False):
+        result = run_for_query_http(query, ws_results, pool)
+        if result == "captcha":
+            captcha_counted = True
+        elif result:
+            return result
+
+    def on_captcha():
+        nonlocal captcha_counted
+        CAPTCHAS.inc()
+        if not captcha_counted:
+            PACING.on_captcha()
+        captcha_counted = False
+
     retries = CONFIG.get("max_retries_per_query", 3)
-    backoffs = CONFIG.get("captcha_backoff_sec", [120, 300])
+    had_captcha = False
     ua_list = CONFIG.get("rotate_user_agents", [])
 
     for attempt in range(1, retries + 1):
         log(f"[QUERY] Попытка {attempt}/{retries}")
+        if attempt > 1:
+            RETRIES.inc()
+            captcha_counted = False
         
         ua = random.choice(ua_list) if ua_list else None
-        driver = create_driver(user_agent=ua)
-        
+        try:
+            driver = pool.acquire(user_agent=ua)
+        except Exception as e:
+            log(f"[QUERY] Не удалось запустить браузер: {e}")
+            continue
+
+        broken = False
         try:
             status = human_like_search_flow(driver, query)
 
             # Капча на входе
             if status == "captcha":
+                on_captcha()
+                had_captcha = True
                 if CONFIG.get("manual_captcha_mode", True):
-                    solved = wait_user_to_solve_captcha(driver, query)
+                    solved = wait_user_to_solve_captcha(driver, query, pool.cookies_path)
                     if not solved:
-                        backoff = backoffs[min(attempt - 1, len(backoffs) - 1)]
+                        backoff = PACING.captcha_backoff(attempt)
                         log(f"[QUERY] Бэкофф {backoff} сек")
                         time.sleep(backoff)
                         continue
                 else:
-                    backoff = backoffs[min(attempt - 1, len(backoffs) - 1)]
+                    backoff = PACING.captcha_backoff(attempt)
                     time.sleep(backoff)
                     continue
 
@@ -665,20 +2156,23 @@ def run_for_query(query, ws_results):
 
             # Проверяем капчу ещё раз
             if is_yandex_captcha(driver):
+                on_captcha()
+                had_captcha = True
                 if CONFIG.get("manual_captcha_mode", True):
-                    solved = wait_user_to_solve_captcha(driver, query)
+                    solved = wait_user_to_solve_captcha(driver, query, pool.cookies_path)
                     if not solved:
-                        backoff = backoffs[min(attempt - 1, len(backoffs) - 1)]
+                        backoff = PACING.captcha_backoff(attempt)
                         time.sleep(backoff)
                         continue
                 else:
-                    backoff = backoffs[min(attempt - 1, len(backoffs) - 1)]
+                    backoff = PACING.captcha_backoff(attempt)
                     time.sleep(backoff)
                     continue
 
             # Парсим рекламу
             ads = parse_ads_positions(driver)
             log(f"[QUERY] Найдено {len(ads)} рекламных позиций")
+            ADS_FOUND.inc(len(ads))
 
             # Резолвим URL если нужно
             if ads and CONFIG.get("resolve_final_url", False):
@@ -694,56 +2188,629 @@ def run_for_query(query, ws_results):
             # Скриншот
             ts = timestamp_str()
             safe_name = re.sub(r'[^А-Яа-яA-Za-z0-9_\- ]+', '_', query)[:50]
-            screenshots_dir = CONFIG.get("screenshots_dir", "/app/data/screenshots")
+            screenshots_dir = CONFIG.get("screenshot_dir", "/app/data/screenshots")
             os.makedirs(screenshots_dir, exist_ok=True)
-            local_png = os.path.join(screenshots_dir, f"{safe_name}_{ts}.png")
-            fullpage_screenshot(driver, local_png)
+            local_shot = capture_screenshot(driver, os.path.join(screenshots_dir, f"{safe_name}_{ts}"))
+            if CONFIG.get("save_serp_html", False):
+                save_serp_html(driver, f"{safe_name}_{ts}")
 
-            # Загружаем на Drive
+            # Загружаем на Drive (в фоне, если есть загрузчик)
             drive_link = None
             try:
-                _, drive_link = upload_to_drive(local_png, os.path.basename(local_png))
+                if uploader:
+                    drive_link = uploader.submit(local_shot, os.path.basename(local_shot))
+                else:
+                    _, drive_link = upload_to_drive(local_shot, os.path.basename(local_shot))
             except Exception as e:
                 log(f"[DRIVE] Не удалось загрузить: {e}")
 
             # Запись в Results
+            drive_link = drive_link or ""
             if not ads:
-                ws_results.append_row([ts, query, "", "SUCCESS_NO_ADS", "", driver.current_url, "yandex.ru"])
+                ws_results.append_row([ts, query, "", "SUCCESS_NO_ADS", "", driver.current_url, "yandex.ru", drive_link])
                 log(f"[QUERY] Реклама не найдена")
             else:
                 rows = [
-                    [ts, query, it["position"], "SUCCESS", it["title"], it["url"], it["domain"]]
+                    [ts, query, it["position"], "SUCCESS", it["title"], it["url"], it["domain"], drive_link]
                     for it in ads
                 ]
                 ws_results.append_rows(rows, value_input_option="USER_ENTERED")
                 log(f"[QUERY] Записано {len(rows)} строк")
 
             # Сохраняем cookies после успешного запроса
-            save_cookies(driver)
+            save_cookies(driver, pool.cookies_path)
 
             # Пауза между запросами
-            pause = random.uniform(*CONFIG.get("per_query_pause_sec", (30, 60)))
+            if not had_captcha:
+                PACING.on_success()
+            pause = PACING.next_pause()
             log(f"[QUERY] Пауза {pause:.0f} сек")
             time.sleep(pause)
-            return
+            return {"ok": True, "attempts": attempt}
 
         except Exception as e:
             log(f"[QUERY] Ошибка: {e}")
+            if isinstance(e, TimeoutException):
+                TIMEOUTS.labels("page_load").inc()
+            broken = True
         finally:
-            safe_quit_driver(driver)
+            pool.release(driver, broken=broken)
 
     log(f"[QUERY] Все попытки исчерпаны для: {query}")
+    return {"ok": False, "attempts": retries}
+
+# Параллельный прогон запросов
+class _ResultsSlot:
+    """Копит строки одного запроса вместо немедленной записи в лист."""
+
+    def __init__(self):
+        self.calls = []
+
+    def append_row(self, values, **kwargs):
+        self.calls.append(([values], kwargs))
+
+    def append_rows(self, values, **kwargs):
+        self.calls.append((list(values), kwargs))
+
+
+class OrderedResultsWriter:
+    """
+    Пишет строки в Results в порядке запросов, даже если параллельные
+    сессии завершают их вразнобой: строки запроса уходят в лист только
+    после того, как записаны все предыдущие запросы.
+    """
+
+    def __init__(self, ws, on_written=None):
+        self.ws = ws
+        self.on_written = on_written  # колбэк(index) после передачи строк запроса в ws
+        self._slots = {}
+        self._done = set()
+        self._next = 0
+        self._lock = threading.Lock()
+
+    def slot(self, index):
+        with self._lock:
+            return self._slots.setdefault(index, _ResultsSlot())
+
+    def complete(self, index):
+        with self._lock:
+            self._done.add(index)
+            while self._next in self._done:
+                slot = self._slots.pop(self._next, None)
+                self._done.discard(self._next)
+                self._next += 1
+                written = True
+                for rows, kwargs in (slot.calls if slot else []):
+                    try:
+                        self.ws.append_rows(rows, **kwargs)
+                    except Exception as e:
+                        written = False
+                        log(f"[RESULTS] Ошибка записи {len(rows)} строк: {e}")
+                if written and self.on_written:
+                    self.on_written(self._next - 1)
+
+
+def session_cookies_path(index):
+    """Первая сессия использует основной файл cookies, остальные — свои копии."""
+    base = CONFIG["cookies_path"]
+    if index == 0:
+        return base
+    root, ext = os.path.splitext(base)
+    return f"{root}_s{index}{ext}"
+
+
+def build_session_pools():
+    """Создаёт по пулу браузеров на каждую изолированную сессию."""
+    count = max(1, int(CONFIG.get("parallel_sessions", 1)))
+    ua_list = CONFIG.get("rotate_user_agents", [])
+    pools = []
+    for i in range(count):
+        # Одна сессия — как раньше, UA ротируется на каждой попытке.
+        # Несколько — у каждой свой закреплённый UA, чтобы личности не смешивались.
+        ua = ua_list[i % len(ua_list)] if (count > 1 and ua_list) else None
+        pools.append(DriverPool(
+            size=CONFIG.get("driver_pool_size", 1),
+            max_uses=CONFIG.get("driver_max_uses", 20),
+            cookies_path=session_cookies_path(i),
+            user_agent=ua,
+        ))
+    return pools
+
+
+def run_queries(queries, writer, pools, uploader=None, on_result=None, positions=None):
+    """
+    Раздаёт запросы по сессиям. Каждая сессия берёт следующий запрос из общей
+    очереди и держит свою «человеческую» паузу, так что суммарная скорость
+    растёт примерно пропорционально числу сессий.
+    on_result(index, result, slot) вызывается сразу после обработки запроса.
+    positions[index] — место запроса в writer, если там есть и другие строки (кэш).
+    """
+    tasks = queue.Queue()
+    for item in enumerate(queries):
+        tasks.put(item)
+    total = len(queries)
+
+    def worker(n, pool):
+        # Разносим старт сессий, чтобы они не стучались в Яндекс одновременно
+        if n:
+            time.sleep(PACING.next_pause() * n / len(pools))
+        while True:
+            try:
+                i, q = tasks.get_nowait()
+            except queue.Empty:
+                return
+            log(f"[S{n + 1}] [{i + 1}/{total}] {q}")
+            pos = positions[i] if positions else i
+            slot = writer.slot(pos)
+            result = {"ok": False, "attempts": 0}
+            try:
+                result = run_for_query(q, slot, pool, uploader)
+            except Exception as e:
+                log(f"[S{n + 1}] Ошибка запроса {q}: {e}")
+            finally:
+                if on_result:
+                    on_result(i, result, slot)
+                writer.complete(pos)
+
+    if len(pools) == 1:
+        worker(0, pools[0])
+        return
+
+    threads = [
+        threading.Thread(target=worker, args=(n, pool), name=f"session-{n + 1}", daemon=True)
+        for n, pool in enumerate(pools)
+    ]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
 
 MOSCOW_TZ = ZoneInfo("Europe/Moscow")
 
+# Журнал запусков: переживает рестарт контейнера посреди прогона
+class RunJournal:
+    """
+    SQLite-журнал прогонов: run_id, окно расписания, статус и попытки по каждому
+    запросу и его строки результата. Статусы запроса:
+      pending → scraped (строки сохранены в журнале) → done (строки отданы в Results)
+      или failed (все попытки исчерпаны).
+    После рестарта незавершённый прогон текущего окна продолжается с того же места:
+    done пропускаются, scraped дописываются в Results без повторного парсинга.
+    """
+
+    def __init__(self, path=None):
+        self.path = path or CONFIG.get("run_journal_path", "/app/data/run_journal.sqlite3")
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(self.path, check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.executescript("""
+            CREATE TABLE IF NOT EXISTS runs (
+                run_id       TEXT PRIMARY KEY,
+                sched_window TEXT NOT NULL,
+                started_at   TEXT NOT NULL,
+                finished_at  TEXT
+            );
+            CREATE TABLE IF NOT EXISTS run_queries (
+                run_id     TEXT NOT NULL,
+                idx        INTEGER NOT NULL,
+                query      TEXT NOT NULL,
+                status     TEXT NOT NULL DEFAULT 'pending',
+                attempts   INTEGER NOT NULL DEFAULT 0,
+                rows_json  TEXT,
+                updated_at TEXT,
+                PRIMARY KEY (run_id, idx)
+            );
+            CREATE INDEX IF NOT EXISTS runs_window ON runs (sched_window);
+            CREATE TABLE IF NOT EXISTS result_cache (
+                norm_query   TEXT PRIMARY KEY,
+                sched_window TEXT NOT NULL,
+                scraped_at   REAL NOT NULL,
+                rows_json    TEXT NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS query_schedule (
+                norm_query TEXT PRIMARY KEY,
+                served_at  REAL NOT NULL
+            );
+        """)
+        self._db.commit()
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+    def unfinished_run(self, window=None):
+        """Последний незавершённый прогон окна window (None — любого окна)."""
+        sql = "SELECT run_id FROM runs WHERE finished_at IS NULL"
+        params = ()
+        if window is not None:
+            sql += " AND sched_window = ?"
+            params = (window,)
+        with self._lock:
+            row = self._db.execute(sql + " ORDER BY started_at DESC LIMIT 1", params).fetchone()
+        return row[0] if row else None
+
+    def run_plan(self, run_id):
+        """(окно, запросы по порядку) прогона — чтобы доделать его в следующем такте."""
+        with self._lock:
+            row = self._db.execute("SELECT sched_window FROM runs WHERE run_id = ?", (run_id,)).fetchone()
+            queries = [q for (q,) in self._db.execute(
+                "SELECT query FROM run_queries WHERE run_id = ? ORDER BY idx", (run_id,)
+            )]
+        return (row[0] if row else None), queries
+
+    def begin(self, window, queries):
+        """
+        Открывает (или продолжает) прогон окна window.
+        Возвращает (run_id, todo, replay): todo — [(idx, query)] для парсинга,
+        replay — [(idx, rows)] уже распарсенных, но не записанных в Results.
+        """
+        run_id = self.unfinished_run(window)
+        now = datetime.now().isoformat(timespec="seconds")
+        with self._lock:
+            if run_id:
+                log(f"[JOURNAL] Продолжаю прерванный прогон {run_id}")
+            else:
+                run_id = datetime.now().strftime("%Y%m%d-%H%M%S-%f")  # с микросекундами: два прогона в одну секунду не столкнутся
+                self._db.execute(
+                    "INSERT INTO runs (run_id, sched_window, started_at) VALUES (?, ?, ?)",
+                    (run_id, window, now),
+                )
+            self._db.executemany(
+                "INSERT OR IGNORE INTO run_queries (run_id, idx, query, updated_at) VALUES (?, ?, ?, ?)",
+                [(run_id, i, q, now) for i, q in enumerate(queries)],
+            )
+
+            # Что уже сделано в этом окне (в том числе прошлыми прогонами)
+            done, scraped = set(), {}
+            for idx, query, status, rows_json in self._db.execute(
+                "SELECT q.idx, q.query, q.status, q.rows_json FROM run_queries q "
+                "JOIN runs r ON r.run_id = q.run_id "
+                "WHERE r.sched_window = ? AND q.status IN ('done', 'scraped')",
+                (window,),
+            ):
+                if status == "done":
+                    done.add((idx, query))
+                else:
+                    scraped[(idx, query)] = json.loads(rows_json or "[]")
+            self._db.commit()
+
+        todo, replay = [], []
+        for i, q in enumerate(queries):
+            if (i, q) in done:
+                continue
+            if (i, q) in scraped:
+                replay.append((i, [(opt, _decode_spool_row(row)) for opt, row in scraped[(i, q)]]))
+            else:
+                todo.append((i, q))
+        skipped = len(queries) - len(todo) - len(replay)
+        if skipped or replay:
+            log(f"[JOURNAL] Уже готово в этом окне: {skipped}, дописать без парсинга: {len(replay)}")
+        return run_id, todo, replay
+
+    def record(self, run_id, idx, ok, attempts, calls=None):
+        """Результат парсинга запроса. calls — [(rows, kwargs)] из _ResultsSlot."""
+        rows = [
+            (kwargs.get("value_input_option", "RAW"), _encode_spool_row(row))
+            for call_rows, kwargs in (calls or []) for row in call_rows
+        ]
+        with self._lock:
+            self._db.execute(
+                "UPDATE run_queries SET status = ?, attempts = attempts + ?, rows_json = ?, updated_at = ? "
+                "WHERE run_id = ? AND idx = ?",
+                ("scraped" if ok else "failed", attempts, json.dumps(rows, ensure_ascii=False),
+                 datetime.now().isoformat(timespec="seconds"), run_id, idx),
+            )
+            self._db.commit()
+
+    def mark_written(self, run_id, idx):
+        with self._lock:
+            self._db.execute(
+                "UPDATE run_queries SET status = 'done', updated_at = ? "
+                "WHERE run_id = ? AND idx = ? AND status = 'scraped'",
+                (datetime.now().isoformat(timespec="seconds"), run_id, idx),
+            )
+            self._db.commit()
+
+    def cached_result(self, norm_query, window, ttl):
+        """Строки прошлого парсинга запроса: в этом же окне или не старше ttl сек. Иначе None."""
+        with self._lock:
+            row = self._db.execute(
+                "SELECT sched_window, scraped_at, rows_json FROM result_cache WHERE norm_query = ?",
+                (norm_query,),
+            ).fetchone()
+        if not row:
+            return None
+        cached_window, scraped_at, rows_json = row
+        if cached_window != window and time.time() - scraped_at > ttl:
+            return None
+        return [([_decode_spool_row(r)], {"value_input_option": opt}) for opt, r in json.loads(rows_json)]
+
+    def cache_result(self, norm_query, window, calls):
+        rows = [
+            (kwargs.get("value_input_option", "RAW"), _encode_spool_row(row))
+            for call_rows, kwargs in calls for row in call_rows
+        ]
+        with self._lock:
+            self._db.execute(
+                "INSERT OR REPLACE INTO result_cache (norm_query, sched_window, scraped_at, rows_json) "
+                "VALUES (?, ?, ?, ?)",
+                (norm_query, window, time.time(), json.dumps(rows, ensure_ascii=False)),
+            )
+            self._db.commit()
+
+    def served(self):
+        """{норм. запрос: активное время (active_seconds) прошлого прогона}."""
+        with self._lock:
+            return dict(self._db.execute("SELECT norm_query, served_at FROM query_schedule"))
+
+    def mark_served(self, served):
+        with self._lock:
+            self._db.executemany(
+                "INSERT OR REPLACE INTO query_schedule (norm_query, served_at) VALUES (?, ?)",
+                list(served.items()),
+            )
+            self._db.commit()
+
+    def finish(self, run_id):
+        with self._lock:
+            self._db.execute(
+                "UPDATE runs SET finished_at = ? WHERE run_id = ?",
+                (datetime.now().isoformat(timespec="seconds"), run_id),
+            )
+            self._db.commit()
+
+
+# Архив выдачи: append-only, файл на месяц
+class SerpArchive:
+    """
+    Локальный архив каждой распарсенной выдачи: archive_dir/serp_YYYY-MM.sqlite3.
+    Пишется только то, что реально спарсили (без дублей и кэша), строки не меняются.
+    Запросы — по нужным месяцам, дальше pandas.
+    """
+
+    COLUMNS = ["ts", "date", "query", "norm_query", "position", "status",
+               "title", "url", "domain", "screenshot", "run_id"]
+
+    def __init__(self, directory=None):
+        self.dir = directory or CONFIG.get("archive_dir", "/app/data/archive")
+        self._lock = threading.Lock()
+        self._conns = {}
+
+    def close(self):
+        with self._lock:
+            for db in self._conns.values():
+                db.close()
+            self._conns.clear()
+
+    def _partition(self, month):
+        db = self._conns.get(month)
+        if db is None:
+            os.makedirs(self.dir, exist_ok=True)
+            db = sqlite3.connect(os.path.join(self.dir, f"serp_{month}.sqlite3"), check_same_thread=False)
+            db.executescript("""
+                CREATE TABLE IF NOT EXISTS serp (
+                    ts         TEXT NOT NULL,
+                    date       TEXT NOT NULL,
+                    query      TEXT NOT NULL,
+                    norm_query TEXT NOT NULL,
+                    position   INTEGER,
+                    status     TEXT NOT NULL,
+                    title      TEXT,
+                    url        TEXT,
+                    domain     TEXT,
+                    screenshot TEXT,
+                    run_id     TEXT
+                );
+                CREATE INDEX IF NOT EXISTS serp_date ON serp (date);
+                CREATE INDEX IF NOT EXISTS serp_query ON serp (norm_query, date);
+            """)
+            self._conns[month] = db
+        return db
+
+    def append(self, calls, run_id=None):
+        """calls — [(rows, kwargs)] из _ResultsSlot; строки в формате листа Results."""
+        records = []
+        for rows, _ in calls:
+            for ts, query, position, status, title, url, domain, shot in rows:
+                date = str(ts)[:10]
+                if isinstance(shot, DriveLink):
+                    shot = shot.path
+                records.append((
+                    ts, date, query, normalize_query(query),
+                    int(position) if str(position).strip() else None,
+                    status, title, url, domain, shot or None, run_id,
+                ))
+        by_month = {}
+        for r in records:
+            by_month.setdefault(r[1][:7], []).append(r)
+        with self._lock:
+            for month, items in by_month.items():
+                db = self._partition(month)
+                db.executemany(f"INSERT INTO serp VALUES ({', '.join('?' * len(self.COLUMNS))})", items)
+                db.commit()
+        return len(records)
+
+    def load(self, date_from=None, date_to=None, norm_query=None):
+        """DataFrame строк архива за период [date_from, date_to] (YYYY-MM-DD, включительно)."""
+        date_from = date_from or "0000-00-00"
+        date_to = date_to or "9999-99-99"
+        sql = "SELECT * FROM serp WHERE date BETWEEN ? AND ?"
+        params = [date_from, date_to]
+        if norm_query is not None:
+            sql += " AND norm_query = ?"
+            params.append(norm_query)
+
+        frames = []
+        for path in sorted(glob.glob(os.path.join(self.dir, "serp_*.sqlite3"))):
+            month = os.path.basename(path)[len("serp_"):-len(".sqlite3")]
+            if not (date_from[:7] <= month <= date_to[:7]):
+                continue  # партиция вне периода — даже не открываем
+            with contextlib.closing(sqlite3.connect(f"file:{path}?mode=ro", uri=True)) as db:
+                frames.append(pd.read_sql_query(sql, db, params=params))
+        if not frames:
+            return pd.DataFrame(columns=self.COLUMNS)
+        return pd.concat(frames, ignore_index=True)
+
+    def share_of_voice(self, date_from=None, date_to=None):
+        """Доля рекламных показов по доменам: показы, доля, в скольких запросах, средняя позиция, сколько раз первым."""
+        ads = self.load(date_from, date_to)
+        ads = ads[ads["status"] == "SUCCESS"]
+        if ads.empty:
+            return pd.DataFrame(columns=["domain", "impressions", "share", "queries", "avg_position", "first"])
+        out = ads.groupby("domain").agg(
+            impressions=("position", "size"),
+            queries=("norm_query", "nunique"),
+            avg_position=("position", "mean"),
+            first=("position", lambda p: int((p == 1).sum())),
+        )
+        out["share"] = out["impressions"] / out["impressions"].sum()
+        out = out.sort_values("impressions", ascending=False).reset_index()
+        return out[["domain", "impressions", "share", "queries", "avg_position", "first"]]
+
+    def position_history(self, query, date_from=None, date_to=None, domain=None):
+        """Позиции рекламы по запросу во времени: ts × домен → позиция."""
+        rows = self.load(date_from, date_to, norm_query=normalize_query(query))
+        rows = rows[rows["status"] == "SUCCESS"]
+        if domain:
+            rows = rows[rows["domain"] == domain]
+        if rows.empty:
+            return pd.DataFrame()
+        return rows.pivot_table(index="ts", columns="domain", values="position", aggfunc="min").sort_index()
+
+    def ad_counts(self, date_from=None, date_to=None):
+        """По дням: сколько выдач сняли, сколько рекламы нашли, в среднем на выдачу, доля выдач без рекламы."""
+        rows = self.load(date_from, date_to)
+        if rows.empty:
+            return pd.DataFrame(columns=["date", "serps", "ads", "ads_per_serp", "no_ads_share"])
+        rows["serp"] = rows["ts"] + "\t" + rows["norm_query"]
+        by_day = rows.groupby("date")
+        out = pd.DataFrame({
+            "serps": by_day["serp"].nunique(),
+            "ads": by_day["status"].apply(lambda s: int((s == "SUCCESS").sum())),
+            "no_ads": by_day["status"].apply(lambda s: int((s == "SUCCESS_NO_ADS").sum())),
+        })
+        out["ads_per_serp"] = out["ads"] / out["serps"]
+        out["no_ads_share"] = out["no_ads"] / out["serps"]
+        return out.reset_index()[["date", "serps", "ads", "ads_per_serp", "no_ads_share"]]
+
+WEEK_SEC = 7 * 24 * 3600
+
+FREQUENCY_ALIASES = {
+    "high": "2/d", "высокий": "2/d",
+    "medium": "1/d", "средний": "1/d", "daily": "1/d", "ежедневно": "1/d",
+    "low": "1/w", "низкий": "1/w", "weekly": "1/w", "еженедельно": "1/w",
+}
+FREQUENCY_RE = re.compile(r"^(\d+(?:[.,]\d+)?)\s*(?:/|раз\s*в)?\s*(d|day|д|день|w|week|н|нед|неделю)$")
+
+def _frequency_per_week(raw):
+    raw = FREQUENCY_ALIASES.get(raw, raw)
+    m = FREQUENCY_RE.match(raw)
+    if not m:
+        return None
+    n = float(m.group(1).replace(",", "."))
+    per_week = n * 7 if m.group(2)[0] in "dд" else n
+    return max(per_week, 0.01)
+
+_DEFAULT_PER_WEEK = None
+
+def default_frequency():
+    """default_query_frequency → запусков в неделю; разбирается один раз, кривое значение — 2/w."""
+    global _DEFAULT_PER_WEEK
+    if _DEFAULT_PER_WEEK is None:
+        raw = str(CONFIG.get("default_query_frequency") or "").strip().lower()
+        _DEFAULT_PER_WEEK = _frequency_per_week(raw)
+        if _DEFAULT_PER_WEEK is None:
+            log(f"[SCHEDULE] default_query_frequency={raw!r} не разобрать, беру 2/w")
+            _DEFAULT_PER_WEEK = 2.0
+    return _DEFAULT_PER_WEEK
+
+def parse_frequency(text):
+    """
+    Частота из колонки C → запусков в неделю.
+    "3/d", "2/день", "1/w", "2 раз в нед", high/medium/low (высокий/средний/низкий).
+    """
+    raw = (text or "").strip().lower()
+    if not raw:
+        return default_frequency()
+    per_week = _frequency_per_week(raw)
+    if per_week is None:
+        log(f"[SCHEDULE] Не понял частоту {text!r}, беру по умолчанию")
+        return default_frequency()
+    return per_week
+
+def active_seconds(now):
+    """
+    Время в «активных» секундах с начала эпохи: ночные часы не считаются,
+    поэтому слоты запросов равномерно ложатся только на рабочие часы.
+    """
+    start_h, end_h = CONFIG.get("schedule_active_hours", (0, 24))
+    day_active = (end_h - start_h) * 3600
+    local = now.astimezone(MOSCOW_TZ)
+    days = (local.date() - datetime(1970, 1, 5).date()).days  # от понедельника
+    into_day = local.hour * 3600 + local.minute * 60 + local.second - start_h * 3600
+    return days * day_active + min(max(into_day, 0), day_active)
+
+def _slot_index(norm, per_week, at):
+    """Номер слота запроса: интервал = активная неделя / частота, фаза — от хэша запроса."""
+    start_h, end_h = CONFIG.get("schedule_active_hours", (0, 24))
+    interval = 7 * (end_h - start_h) * 3600 / per_week
+    phase = (zlib.crc32(norm.encode("utf-8")) / 2 ** 32) * interval
+    return int((at - phase) // interval)
+
+def due_queries(rows, served, now=None):
+    """
+    Запросы, чей очередной слот наступил после прошлого прогона.
+    served — {норм. запрос: активное время прошлого прогона}. Новые запросы
+    просто встают в расписание и пойдут в свой ближайший слот.
+    Частые (ценные) — первыми, чтобы при капчах они успели раньше.
+    """
+    now = now or datetime.now(MOSCOW_TZ)
+    at = active_seconds(now)
+    due, new = [], {}
+    for q, freq in rows:
+        norm = normalize_query(q)
+        per_week = parse_frequency(freq)
+        last = served.get(norm)
+        if last is None:
+            new[norm] = at
+        elif _slot_index(norm, per_week, at) > _slot_index(norm, per_week, last):
+            due.append((per_week, q))
+    due.sort(key=lambda x: -x[0])  # sort стабильный — внутри частоты порядок листа
+    return [q for _, q in due], new
+
+def current_window_start(now=None):
+    """
+    Начало текущего окна расписания: в continuous — начало такта,
+    в burst — последний прошедший пн/пт 10:00 МСК.
+    """
+    if now is None:
+        now = datetime.now(MOSCOW_TZ)
+    if CONFIG.get("schedule_mode", "burst") == "continuous":
+        tick = CONFIG.get("schedule_tick_min", 30) * 60
+        local = now.astimezone(MOSCOW_TZ)
+        midnight = local.replace(hour=0, minute=0, second=0, microsecond=0)
+        return midnight + timedelta(seconds=((local - midnight).total_seconds() // tick) * tick)
+    for days_back in range(0, 8):
+        candidate_date = now.date() - timedelta(days=days_back)
+        if candidate_date.weekday() in {0, 4}:
+            candidate_dt = datetime.combine(candidate_date, dtime(10, 0), tzinfo=MOSCOW_TZ)
+            if candidate_dt <= now:
+                return candidate_dt
+    return now
+
 def seconds_until_next_run(now=None):
     """
-    Считает, сколько секунд осталось до ближайшего запуска
-    в понедельник или пятницу в 10:00 по МСК.
+    Считает, сколько секунд осталось до ближайшего запуска:
+    в continuous — до следующего такта, в burst — до пн/пт 10:00 по МСК.
     """
     if now is None:
         now = datetime.now(MOSCOW_TZ)
 
+    if CONFIG.get("schedule_mode", "burst") == "continuous":
+        tick = CONFIG.get("schedule_tick_min", 30) * 60
+        return max(1.0, (current_window_start(now) + timedelta(seconds=tick) - now).total_seconds())
+
     target_time = dtime(10, 0)  # 10:00
     target_weekdays = {0, 4}    # 0 = понедельник, 4 = пятница
 
@@ -759,47 +2826,218 @@ def seconds_until_next_run(now=None):
     # Теоретически сюда не дойдём, но на всякий случай — сутки ожидания
     return 24 * 3600
 
-def main_once():
+def main_once(journal=None, uploader=None, sink=None):
+    """
+    Один прогон. journal/uploader/sink можно передать снаружи (scheduler_loop держит их
+    весь процесс) — тогда прогон их не закрывает; иначе создаёт свои и закрывает в конце.
+    """
+    continuous = CONFIG.get("schedule_mode", "burst") == "continuous"
+    own_journal, own_uploader, own_sink = journal is None, uploader is None, sink is None
+    if own_journal:
+        journal = RunJournal()
+    queries, window = None, None
+
+    if continuous:
+        now = datetime.now(MOSCOW_TZ)
+        # Прогон, прерванный рестартом или ошибкой в прошлом такте, доделываем в его окне:
+        # иначе его запросы снова станут «due», а записанные строки придут ещё раз из кэша
+        unfinished = journal.unfinished_run()
+        if unfinished:
+            window, queries = journal.run_plan(unfinished)
+            if queries:
+                log(f"[SCHEDULE] Доделываю прерванный прогон {unfinished}: {len(queries)} запросов")
+            else:
+                journal.finish(unfinished)
+                window, queries = None, None
+        if queries is None:
+            # Такт: берём только запросы, чей слот подошёл
+            try:
+                queries, new = due_queries(read_query_rows(), journal.served(), now)
+                if new:
+                    journal.mark_served(new)
+                    log(f"[SCHEDULE] Новых запросов в расписании: {len(new)}")
+            except Exception as e:
+                log(f"[SCHEDULE] Ошибка чтения запросов: {e}")
+                send_telegram(f"❌ Ошибка парсера: {e}")
+                if own_journal:
+                    journal.close()
+                return
+        if not queries:
+            log("[SCHEDULE] В этом такте запросов нет")
+            if own_journal:
+                journal.close()
+            return
+        served_at = active_seconds(now)
+
     log("=== ЗАПУСК ПАРСЕРА ===")
-    send_telegram("🚀 Yandex Parser запущен")
-    
+    if not continuous:
+        send_telegram("🚀 Yandex Parser запущен")
+
+    if own_uploader:
+        uploader = DriveUploader()
+        uploader.start()
+    prune_screenshots(uploader=uploader)
+    archive = SerpArchive() if CONFIG.get("archive_enabled", True) else None
+    pools = build_session_pools()
     try:
-        gc = gsheet_client()
-        ws_results = ensure_results_worksheet(gc)
+        if own_sink:
+            sink = SheetsResultSink(ensure_results_worksheet(), uploader=uploader)
+            sink.start()
         write_run_timestamp()
-        queries = read_queries()
-        
-        log(f"Загружено {len(queries)} запросов")
-        
-        for i, q in enumerate(queries, 1):
-            log(f"[{i}/{len(queries)}] {q}")
-            run_for_query(q, ws_results)
+        if queries is None:
+            queries = read_queries()
+
+        log(f"Загружено {len(queries)} запросов, сессий: {len(pools)}")
+
+        window = window or current_window_start().isoformat()
+        run_id, todo, replay = journal.begin(window, queries)
+
+        def mark_written(idx):
+            journal.mark_written(run_id, idx)
+            if continuous:
+                # слот запроса отработан, как только строки отданы в Results
+                journal.mark_served({normalize_query(queries[idx]): served_at})
+
+        # Распарсили до рестарта, но не успели отдать в Results
+        for idx, entries in replay:
+            for opt, row in entries:
+                sink.append_rows([row], value_input_option=opt)
+            mark_written(idx)
+
+        QUERIES_TOTAL.set(len(queries))
+        QUERIES_PROCESSED.set(len(queries) - len(todo))
+
+        # Одинаковые по смыслу запросы парсим один раз, свежие берём из кэша.
+        # Группа — одна позиция в writer, так что и строки из кэша идут в порядке листа
+        groups = {}
+        for idx, q in todo:
+            groups.setdefault(normalize_query(q), []).append((idx, q))
+        groups = list(groups.items())
+
+        def on_written(pos):
+            for idx, _ in groups[pos][1]:
+                mark_written(idx)
+
+        writer = OrderedResultsWriter(sink, on_written=on_written)
+        # В continuous повтор запроса — это его очередной слот по расписанию, а не дубль:
+        # старые строки из кэша туда не подставляем, только дубли внутри такта
+        ttl = 0 if continuous else CONFIG.get("result_cache_ttl_sec", 0)
+        scrape, positions, reused = [], [], 0
+        for pos, (norm, items) in enumerate(groups):
+            cached = journal.cached_result(norm, window, ttl)
+            if cached is None:
+                scrape.append((norm, items))
+                positions.append(pos)
+                continue
+            slot = writer.slot(pos)
+            for idx, q in items:
+                calls = retarget_calls(cached, q)
+                journal.record(run_id, idx, True, 0, calls)
+                slot.calls.extend(calls)
+            writer.complete(pos)
+            reused += len(items)
+            QUERIES_PROCESSED.inc(len(items))
+        if reused or len(groups) < len(todo):
+            log(f"[CACHE] Из кэша: {reused}, дубликатов: {len(todo) - len(groups)}, парсим: {len(scrape)}")
+
+        def on_result(pos, result, slot):
+            norm, items = scrape[pos]
+            journal.record(run_id, items[0][0], result["ok"], result["attempts"], slot.calls)
+            if result["ok"]:
+                journal.cache_result(norm, window, slot.calls)
+                if archive:
+                    try:
+                        archive.append(slot.calls, run_id)
+                    except Exception as e:
+                        log(f"[ARCHIVE] Ошибка записи: {e}")
+            # Дубликаты получают те же строки со своим написанием запроса — сразу за оригиналом
+            dup_calls = []
+            for idx, q in items[1:]:
+                calls = retarget_calls(slot.calls, q) if result["ok"] else []
+                journal.record(run_id, idx, result["ok"], 0, calls)
+                dup_calls.extend(calls)
+            slot.calls.extend(dup_calls)
+            QUERIES_PROCESSED.inc(len(items))
+            QUERIES_FINISHED.labels("ok" if result["ok"] else "failed").inc(len(items))
+
+        run_queries([items[0][1] for _, items in scrape], writer, pools, uploader,
+                    on_result=on_result, positions=positions)
+        sink.flush(final=True)  # финальный сброс до отчёта в Telegram
+        journal.finish(run_id)
+        if continuous:
+            journal.mark_served({normalize_query(q): served_at for q in queries})
+        LAST_RUN_FINISHED.set_to_current_time()
         
-        send_telegram(f"✅ Парсер завершён. Обработано {len(queries)} запросов.")
+        if not continuous:
+            # в continuous тактов десятки в день — в Telegram только ошибки и капчи
+            send_telegram(f"✅ Парсер завершён. Обработано {len(queries)} запросов.")
         log("=== ПАРСЕР ЗАВЕРШЁН ===")
         
     except Exception as e:
         log(f"[ERROR] {e}")
         send_telegram(f"❌ Ошибка парсера: {e}")
+    finally:
+        for pool in pools:
+            pool.close()
+        if own_sink and sink:
+            sink.close()
+        if own_uploader:
+            uploader.close()
+        if own_journal:
+            journal.close()
+        if archive:
+            archive.close()
 
 def scheduler_loop():
     """Бесконечный цикл планировщика."""
     log("=== YANDEX PARSER STARTED ===")
-
-    while True:
-        now = datetime.now(MOSCOW_TZ)
-        wait_sec = seconds_until_next_run(now)
-        hours = wait_sec / 3600
-
-        log(f"[SCHEDULER] Ждём {hours:.2f} ч до следующего запуска")
-        time.sleep(wait_sec)
-
-        log(f"[SCHEDULER] Запуск в {datetime.now(MOSCOW_TZ)}")
+    start_metrics_server()
+    if CONFIG.get("schedule_mode", "burst") == "continuous":
+        log(f"[SCHEDULE] Частота по умолчанию: {default_frequency():g} раз в неделю")
+
+    # Журнал, очередь Drive и буфер Results живут весь процесс: в continuous такт
+    # каждые полчаса, и пересоздавать их (с перечитыванием очереди с диска) на каждом нельзя
+    journal = RunJournal()
+    uploader = DriveUploader()
+    uploader.start()
+    sink = None
+
+    def run():
+        nonlocal sink
         try:
-            main_once()
+            if sink is None:
+                sink = SheetsResultSink(ensure_results_worksheet(), uploader=uploader)
+                sink.start()
+            main_once(journal=journal, uploader=uploader, sink=sink)
         except Exception as e:
             log(f"[SCHEDULER] Ошибка: {e}")
 
+    try:
+        # Контейнер перезапустился посреди прогона — доделываем его, не дожидаясь расписания
+        continuous = CONFIG.get("schedule_mode", "burst") == "continuous"
+        unfinished = journal.unfinished_run(None if continuous else current_window_start().isoformat())
+        if unfinished:
+            log(f"[SCHEDULER] Найден незавершённый прогон {unfinished} — продолжаю")
+        if unfinished or continuous:
+            # в continuous сразу забираем запросы, чьи слоты прошли, пока контейнер стоял
+            run()
+
+        while True:
+            now = datetime.now(MOSCOW_TZ)
+            wait_sec = seconds_until_next_run(now)
+            hours = wait_sec / 3600
+
+            log(f"[SCHEDULER] Ждём {hours:.2f} ч до следующего запуска")
+            time.sleep(wait_sec)
+
+            log(f"[SCHEDULER] Запуск в {datetime.now(MOSCOW_TZ)}")
+            run()
+    finally:
+        if sink:
+            sink.close()
+        uploader.close()
+        journal.close()
+
 
 if __name__ == "__main__":
     if os.environ.get("SMOKE_TEST", "").lower() == "true":